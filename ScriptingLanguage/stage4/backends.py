@@ -0,0 +1,145 @@
+"""
+Where forecasts come from
+
+Each backend has fetch(location, time) returning the forecast json (as a
+dictionary, in the same format as forecast.io) or raising an exception.
+
+HTTPBackend      - the forecast.io API (or anything that looks like it, e.g. standin.py)
+FixtureBackend   - forecasts recorded earlier, so we can work without a network
+RecordingBackend - passes requests to another backend and saves the answers as fixtures
+"""
+import os
+import json
+import threading
+from httppool import ConnectionPool
+
+# The real forecast server
+API = "https://api.forecast.io"
+# The most connections to the forecast server at once
+_CONNECTIONS = 4
+# How many seconds to wait for the forecast server
+_TIMEOUT = 10
+
+
+def fixture_name(location, time):
+    """
+    The file name for a recorded forecast
+    :param location: The (lat, lon) of location
+    :param time: The unix timestamp
+    :return: lat,lon,time.json
+    """
+    return "%.4f,%.4f,%d.json" % (location[0], location[1], time)
+
+
+class HTTPBackend(object):
+
+    def __init__(self, key, base=API, connections=_CONNECTIONS, timeout=_TIMEOUT):
+        """
+        Fetch forecasts from a forecast.io style server
+        :param key: The API key
+        :param base: The scheme and host of the server (e.g. http://127.0.0.1:34568 for the stand-in)
+        :param connections: The most connections to the server at once
+        :param timeout: How many seconds to wait for the server
+        :return: None
+        """
+        self.key = key
+        self.base = base.rstrip("/")
+        # Reuses connections to the server (saves the TCP and TLS handshakes)
+        self.pool = ConnectionPool(connections, timeout)
+
+    def fetch(self, location, time):
+        """
+        Fetch the forecast
+        :param location: The (lat, lon) of location
+        :param time: The unix timestamp
+        :return: The json as a dictionary
+        """
+        url = "{base}/forecast/{key}/{latitude},{longitude},{time}?units=si".format(
+            base=self.base, key=self.key, latitude=location[0], longitude=location[1], time=time
+        )
+        return json.loads(self.pool.get(url))
+
+
+class FixtureBackend(object):
+
+    def __init__(self, path):
+        """
+        Answer with recorded forecasts
+        :param path: A directory of recorded forecasts (named by fixture_name), or a single
+                     file that is the answer for every location and time
+        :return: None
+        """
+        self.path = path
+        # (lat, lon) -> sorted list of (time, file name)
+        self.fixtures = {}
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                try:
+                    lat, lon, time = name[:-len(".json")].split(",")
+                    self.fixtures.setdefault((float(lat), float(lon)), []).append((int(time), name))
+                except ValueError:
+                    # Not a fixture
+                    continue
+            for times in self.fixtures.values():
+                times.sort()
+        # File name -> json, so each file is only read once
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def _load(self, name):
+        """
+        Read a fixture (the first time it is needed)
+        :param name: The file name (in the directory)
+        :return: The json as a dictionary
+        """
+        with self._lock:
+            if name not in self._loaded:
+                with open(os.path.join(self.path, name) if name else self.path) as f:
+                    self._loaded[name] = json.load(f)
+            return self._loaded[name]
+
+    def fetch(self, location, time):
+        """
+        Find the recorded forecast closest to the location, and then to the time
+        :param location: The (lat, lon) of location
+        :param time: The unix timestamp
+        :return: The json as a dictionary
+        """
+        if not os.path.isdir(self.path):
+            # The same answer for everything
+            return self._load(None)
+        if not self.fixtures:
+            raise IOError("There are no forecasts recorded in %s" % self.path)
+        lat, lon = location
+        # The same location if we have it, otherwise the closest
+        recorded = min(self.fixtures, key=lambda key: ((key[0] - lat) ** 2 + (key[1] - lon) ** 2, key))
+        times = self.fixtures[recorded]
+        closest = min(times, key=lambda entry: (abs(entry[0] - time), entry[0]))
+        return self._load(closest[1])
+
+
+class RecordingBackend(object):
+
+    def __init__(self, backend, directory):
+        """
+        Save the forecasts from another backend (for FixtureBackend to replay)
+        :param backend: Where the forecasts come from
+        :param directory: Where to save them
+        :return: None
+        """
+        self.backend = backend
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def fetch(self, location, time):
+        """
+        Fetch the forecast and save a copy
+        :param location: The (lat, lon) of location
+        :param time: The unix timestamp
+        :return: The json as a dictionary
+        """
+        data = self.backend.fetch(location, time)
+        with open(os.path.join(self.directory, fixture_name(location, time)), "w") as f:
+            json.dump(data, f)
+        return data
@@ -0,0 +1,298 @@
+"""
+Small in-process caches
+
+LRUCache keeps the most recently used entries up to a maximum number (and can
+expire them after a number of seconds).
+RangeCache stores answers that hold for a range of values (e.g. every
+departure minute up to the next train) so one entry answers all of them.
+DiskCache keeps entries (that can be stored as json) in a SQLite database, so
+they survive restarts and can be shared by several processes on the same host.
+They are all safe to use from several threads and count their hits and misses.
+"""
+import json
+import time
+import sqlite3
+import threading
+from bisect import bisect_right, insort
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, size, ttl=None, clock=time.time):
+        """
+        Create an empty cache
+        :param size: The most entries to keep (the least recently used are evicted)
+        :param ttl: How many seconds to keep an entry (None to keep it until it is evicted)
+        :param clock: Function giving the current time in seconds
+        :return: None
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        # key -> (time it expires OR None, value)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._clock = clock
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Get an entry
+        :param key: The key
+        :return: The value OR None if not cached
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return
+            expires, value = entry
+            if expires is not None and expires <= self._clock():
+                # Too old, leave it out
+                self.expired += 1
+                self.misses += 1
+                return
+            # Put it back at the end (most recently used)
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        """
+        Get an entry without counting a hit or a miss (or making it recently used)
+        :param key: The key
+        :return: The value OR None if not cached (or it has expired)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > self._clock()):
+                return entry[1]
+
+    def expires(self, key):
+        """
+        When does an entry expire? (doesn't count as a hit or a miss, or make it recently used)
+        :param key: The key
+        :return: The time it expires OR None if it isn't cached (or has already expired)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            expires = entry[0]
+            if expires is None:
+                # Never expires
+                return float("inf")
+            if expires > self._clock():
+                return expires
+
+    def put(self, key, value, expires=None):
+        """
+        Add (or replace) an entry
+        :param key: The key
+        :param value: The value (not None)
+        :param expires: When it expires (None for the ttl from now, e.g. something from another cache keeps its expiry)
+        :return: List of the keys that were evicted to make room
+        """
+        evicted = []
+        with self._lock:
+            self._entries.pop(key, None)
+            if expires is None and self.ttl is not None:
+                expires = self._clock() + self.ttl
+            self._entries[key] = expires, value
+            while len(self._entries) > self.size:
+                # Remove the least recently used
+                evicted.append(self._entries.popitem(last=False)[0])
+        return evicted
+
+    def clear(self):
+        """
+        Remove all the entries (the statistics are kept)
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        How well is the cache doing?
+        :return: Dictionary of hits, misses (including expired entries), expired and entries
+        """
+        return {"hits": self.hits, "misses": self.misses, "expired": self.expired, "entries": len(self._entries)}
+
+
+class RangeCache(object):
+
+    def __init__(self, size):
+        """
+        Create an empty cache
+        :param size: The most ranges to keep (the least recently used are evicted)
+        :return: None
+        """
+        self._ranges = LRUCache(size)
+        # For each key, the start of each range (sorted)
+        self._starts = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, point):
+        """
+        Get the value for a point
+        :param key: The key
+        :param point: Where in the range
+        :return: The value OR None if not cached
+        """
+        with self._lock:
+            starts = self._starts.get(key, [])
+            # The range that starts closest before the point
+            index = bisect_right(starts, point) - 1
+            entry = self._ranges.get((key, starts[index])) if index >= 0 else None
+            if entry is None or point > entry[0]:
+                self.misses += 1
+                return
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, start, end, value):
+        """
+        Add the value for a range
+        :param key: The key
+        :param start: The start of the range
+        :param end: The end of the range (inclusive, None if it never ends)
+        :param value: The value
+        :return: None
+        """
+        with self._lock:
+            starts = self._starts.setdefault(key, [])
+            if (key, start) not in self._ranges:
+                insort(starts, start)
+            for old, old_start in self._ranges.put((key, start), (float("inf") if end is None else end, value)):
+                # Forget where the evicted ranges started
+                self._starts[old].remove(old_start)
+                if not self._starts[old]:
+                    del self._starts[old]
+
+    def clear(self):
+        """
+        Remove all the entries (the statistics are kept)
+        :return: None
+        """
+        with self._lock:
+            self._ranges.clear()
+            self._starts.clear()
+
+    def stats(self):
+        """
+        How well is the cache doing?
+        :return: Dictionary of hits, misses and entries
+        """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._ranges)}
+
+
+class DiskCache(object):
+
+    def __init__(self, path, size, ttl, clock=time.time, timeout=5.0):
+        """
+        Open (or create) a cache in a SQLite database
+        :param path: The file name of the database
+        :param size: The most entries to keep (the oldest are evicted)
+        :param ttl: How many seconds to keep an entry
+        :param clock: Function giving the current time in seconds
+        :param timeout: How many seconds to wait for another process that is writing
+        :return: None
+        """
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        # One connection for every thread (the web server starts a thread per request, a
+        # connection each would leave them open), used by one thread at a time
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        with self._lock, self._connection:
+            # Readers don't block the writer (or each other), so several processes can share it
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                                     "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key):
+        """
+        Get an entry
+        :param key: The key (anything that can be stored as json)
+        :return: The value OR None if not cached (or it has expired, or the database can't be read)
+        """
+        entry = self.entry(key)
+        if entry is not None:
+            return entry[1]
+
+    def entry(self, key):
+        """
+        Get an entry and when it expires (e.g. to keep it in memory until then)
+        :param key: The key (anything that can be stored as json)
+        :return: (time it expires, value) OR None if not cached (or it has expired, or the database can't be read)
+        """
+        with self._lock:
+            try:
+                row = self._connection.execute("SELECT expires, value FROM cache WHERE key = ? AND expires > ?",
+                                               (json.dumps(key), self._clock())).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row is None:
+                self.misses += 1
+                return
+            self.hits += 1
+        return row[0], json.loads(row[1])
+
+    def put(self, key, value):
+        """
+        Add (or replace) an entry, and evict the expired and oldest entries
+        :param key: The key (anything that can be stored as json)
+        :param value: The value (anything that can be stored as json)
+        :return: True if it was stored
+        """
+        now = self._clock()
+        connection = self._connection
+        try:
+            with self._lock, connection:
+                connection.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                                   (json.dumps(key), json.dumps(value), now + self.ttl))
+                connection.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+                # Everything expires after the same time, so the first to expire are the oldest
+                connection.execute("DELETE FROM cache WHERE key IN "
+                                   "(SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)", (self.size,))
+            return True
+        except sqlite3.Error:
+            # The cache is only to save time, so carry on without it
+            return False
+
+    def clear(self):
+        """
+        Remove all the entries (the statistics are kept)
+        :return: None
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache")
+
+    def stats(self):
+        """
+        How well is the cache doing?
+        :return: Dictionary of hits, misses and entries
+        """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
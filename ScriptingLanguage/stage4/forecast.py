@@ -1,12 +1,42 @@
-from json import loads, load
 from pprint import pprint
+from math import floor
 from datetime import datetime
-import urllib2
+from bisect import bisect_right
+import sqlite3
+import threading
+import os
+from cache import LRUCache, DiskCache
+from backends import HTTPBackend, FixtureBackend, RecordingBackend
 
 # The key read from the file forecastKey
 _API_KEY = [None]
+# Where the forecasts come from, set from the FORECAST_BACKEND environment variable (see backend_from)
+_BACKEND = "FORECAST_BACKEND"
+_backend = []
 # The directions (converting from angle to compass direction)
 _DIRECTIONS = "North/North East/East/South East/South/South West/West/North West/North".split('/')
+# How many seconds a forecast is kept for
+_CACHE_TTL = 15 * 60
+# The most forecasts to keep
+_CACHE_SIZE = 1000
+# Locations in the same square of this many degrees share a forecast (0.05 degrees is about 5km,
+# the forecasts aren't any more detailed than that)
+_GRID = [0.05]
+# Location -> the centre of its grid square (worked out when the stations load)
+_cells = {}
+# The hours shown in the weather strip
+_STRIP = 6
+# The forecasts fetched recently (each has every hour of a day), by rounded location and date
+_cache = LRUCache(_CACHE_SIZE, _CACHE_TTL)
+# The most forecasts to keep on disk
+_DISK_SIZE = 10000
+# The cache on disk that survives restarts (if one is being used)
+_disk = []
+# The days being fetched, by cache key -> [Event set when done, forecast for the day]
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+# How many lookups waited for another thread's fetch rather than fetching it again
+_coalesced = [0]
 
 # Read the key file
 def _get_key():
@@ -25,15 +55,185 @@ def _get_time(unix):
     time = datetime.fromtimestamp(unix)
     return time.strftime('%H:%M')
 
-# Fetch a file from internet
-def _fetch(url):
-    response = urllib2.urlopen(url)
-    return load(response)
+def backend_from(setting):
+    """
+    Make a backend from a setting
+    :param setting: Empty for forecast.io, a url for a server like it (e.g. standin.py),
+                    fixtures:<directory or file> to answer with recorded forecasts, or
+                    record:<directory> to fetch from forecast.io and save what comes back
+    :return: The backend
+    """
+    kind, _, path = setting.partition(":")
+    if kind == "fixtures":
+        return FixtureBackend(path)
+    if kind == "record":
+        return RecordingBackend(HTTPBackend(_API_KEY[0]), path)
+    if setting:
+        return HTTPBackend(_API_KEY[0], setting)
+    return HTTPBackend(_API_KEY[0])
+
+def use_backend(backend):
+    """
+    Change where the forecasts come from (the forecasts already cached are kept)
+    :param backend: Anything with fetch(location, time) returning the forecast.io json, see backends.py
+    :return: None
+    """
+    _backend[:] = [backend]
+
+# The backend to start with
+use_backend(backend_from(os.environ.get(_BACKEND, "")))
+
+# The centre of the grid square a location is in
+def _centre(location):
+    size = _GRID[0]
+    return tuple(round((floor(degrees / size) + 0.5) * size, 6) for degrees in location)
+
+# The grid square a location is in (every location in it gets the same forecast)
+def _cell(location):
+    cell = _cells.get(location)
+    if cell is None:
+        cell = _centre(location)
+    return cell
+
+# The cache key for a grid square and time (every hour of the day has the same key)
+def _key(cell, time):
+    return cell[0], cell[1], datetime.fromtimestamp(time).toordinal()
+
+def snap(locations):
+    """
+    Work out the grid square of each location now (e.g. every station), rather than for every forecast
+    :param locations: List of (lat, lon)
+    :return: The number of grid squares they are in
+    """
+    cells = dict((tuple(location), _centre(location)) for location in locations)
+    _cells.update(cells)
+    return len(set(cells.values()))
+
+def configure_grid(size):
+    """
+    Change the size of the grid squares that share a forecast
+    :param size: The width of a square in degrees
+    :return: None
+    """
+    _GRID[0] = size
+    # Work out the squares again, the forecasts cached are for the old squares
+    locations = list(_cells)
+    _cells.clear()
+    snap(locations)
+    _cache.clear()
+
+def configure_cache(size=None, ttl=None):
+    """
+    Change how forecasts are cached
+    :param size: The most forecasts to keep (None to leave it as it is)
+    :param ttl: How many seconds to keep a forecast (None to leave it as it is, applies to new forecasts)
+    :return: None
+    """
+    if size is not None:
+        _cache.size = size
+    if ttl is not None:
+        _cache.ttl = ttl
+
+def use_disk_cache(path, size=_DISK_SIZE, ttl=_CACHE_TTL):
+    """
+    Also keep the forecasts in a SQLite database (which can be shared by several processes)
+    :param path: The file name of the database
+    :param size: The most forecasts to keep
+    :param ttl: How many seconds to keep a forecast
+    :return: True if the database could be opened
+    """
+    try:
+        _disk[:] = [DiskCache(path, size, ttl)]
+        return True
+    except sqlite3.Error:
+        # Carry on with just the cache in memory
+        return False
+
+def cache_stats():
+    """
+    How well is the forecast cache doing?
+    :return: Dictionary of hits, misses, expired, entries and coalesced (and the disk cache statistics if used)
+    """
+    stats = _cache.stats()
+    stats['coalesced'] = _coalesced[0]
+    if _disk:
+        stats['disk'] = _disk[0].stats()
+    return stats
 
 # Convert direction from angle to compass
 def _direction(angle):
     # -22 to 23 is North, and so on
-    return _DIRECTIONS[(angle + 22) // 45]
+    return _DIRECTIONS[int(round(angle) + 22) // 45]
+
+def _from_disk(key):
+    """
+    Get a forecast fetched before the restart (or by another process), and keep it in memory until it expires on disk
+    :param key: The cache key
+    :return: (time it expires, forecast for the day) OR (None, None) if it isn't on disk
+    """
+    entry = _disk[0].entry(key) if _disk else None
+    if entry is None:
+        return None, None
+    _cache.put(key, entry[1], entry[0])
+    return entry
+
+def _day(location, time):
+    """
+    Get the forecast for every hour of the day (from the cache, or fetched if we don't have it)
+    :param location: The (lat, lon) of location
+    :param time: The unix timestamp
+    :return: Dictionary of the day (or None if there was a problem)
+    """
+    # Every location in the same grid square shares the forecast for its centre
+    cell = _cell(location)
+    key = _key(cell, time)
+    day = _cache.get(key)
+    if day is None:
+        day = _from_disk(key)[1]
+    if day is None:
+        day = _fetch_once(key, cell, time)
+    return day
+
+def _at(day, location, time):
+    """
+    Work out the weather at a time from the hourly forecasts (in between hours are interpolated)
+    :param day: The forecast for the day
+    :param location: The (lat, lon) of location
+    :param time: The unix timestamp
+    :return: A dictionary of results
+    """
+    hours = day['hours']
+    # The hours either side of the time
+    after = bisect_right([hour['time'] for hour in hours], time)
+    before = hours[max(after - 1, 0)]
+    after = hours[min(after, len(hours) - 1)]
+    # How far between them (0 is the hour before)
+    fraction = float(time - before['time']) / (after['time'] - before['time']) if after is not before else 0.0
+
+    def between(name):
+        return round(before[name] + (after[name] - before[name]) * fraction, 1)
+
+    # Turn the shortest way between the wind bearings (e.g. 350 to 10 goes through north)
+    turn = (after['windBearing'] - before['windBearing'] + 180) % 360 - 180
+    bearing = int(round(before['windBearing'] + turn * fraction)) % 360
+    # The words and icon are from the closest hour
+    closest = before if fraction < 0.5 else after
+    return {'temperature': between('temperature'),
+            'feelsLike': between('feelsLike'),
+            'summary': closest['summary'],
+            'icon': closest['icon'],
+            'windSpeed': between('windSpeed'),
+            'windBearing': _direction(bearing),
+            'windDirection': bearing,
+            'low': day['low'],
+            'high': day['high'],
+            'dailySummary': day['dailySummary'],
+            'sunrise': day['sunrise'],
+            'sunset': day['sunset'],
+            'time': _get_time(time),
+            'latitude': location[0],
+            'longitude': location[1],
+            }
 
 def forecast(location, time):
     """
@@ -42,37 +242,155 @@ def forecast(location, time):
     :param time: The unix timestamp
     :return: A dictionary of results (or None if there was a problem)
     """
-    url = "https://api.forecast.io/forecast/{key}/{latitude},{longitude},{time}?units=si".format(
-        key=_API_KEY[0], latitude=location[0], longitude=location[1], time=time
-    )
+    day = _day(location, time)
+    if day:
+        return _at(day, location, time)
+
+def hourly(location, time, hours=_STRIP):
+    """
+    Get the forecast for the hours from a time (to the end of that day, so nothing more is fetched)
+    :param location: The (lat, lon) of location
+    :param time: The unix timestamp
+    :param hours: The most hours
+    :return: List of forecasts (as returned by forecast) for each hour
+    """
+    day = _day(location, time)
+    if not day:
+        return []
+    return [_at(day, location, hour['time']) for hour in day['hours'] if hour['time'] >= time][:hours]
+
+def shared(location, time):
+    """
+    Which forecast does a location and time use? (the same for every hour of the day in a grid square)
+    :param location: The (lat, lon) of location
+    :param time: The unix timestamp
+    :return: The cache key of the forecast
+    """
+    return _key(_cell(location), time)
+
+def expires(location, time):
+    """
+    When does the cached forecast for a location and time expire? (e.g. to refresh it before then)
+    :param location: The (lat, lon) of location
+    :param time: The unix timestamp
+    :return: The unix time it expires OR None if it isn't cached (in memory or on disk)
+    """
+    key = shared(location, time)
+    expires = _cache.expires(key)
+    if expires is None:
+        # Still fresh on disk after a restart doesn't need fetching again
+        expires = _from_disk(key)[0]
+    return expires
+
+def refresh(location, time):
+    """
+    Fetch the forecast again (even if it is cached) and cache it
+    :param location: The (lat, lon) of location
+    :param time: The unix timestamp
+    :return: True if it was fetched
+    """
+    cell = _cell(location)
+    return _fetch_once(_key(cell, time), cell, time, True) is not None
+
+def forecasts(requests):
+    """
+    Get the forecasts for several locations and times at once (fetched at the same time, so
+    this only takes as long as the slowest one)
+    :param requests: List of (location, unix timestamp)
+    :return: List of the forecasts (None where there was a problem), in the same order as the requests
+    """
+    results = [None] * len(requests)
+
+    def fetch(index):
+        results[index] = forecast(*requests[index])
+
+    # The first one is fetched on this thread, the others on their own threads
+    threads = [threading.Thread(target=fetch, args=(index,)) for index in range(1, len(requests))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    if requests:
+        fetch(0)
+    for thread in threads:
+        thread.join()
+    return results
+
+def _fetch_once(key, location, time, fresh=False):
+    """
+    Fetch the forecast for a day and cache it, if another thread is already fetching the same one wait for that instead
+    :param key: The cache key
+    :param location: The (lat, lon) of location
+    :param time: The unix timestamp
+    :param fresh: Fetch it even if it is cached (to replace it before it expires)
+    :return: The forecast for the day (or None if there was a problem)
+    """
+    with _in_flight_lock:
+        flight = _in_flight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _in_flight[key] = [threading.Event(), None]
+        else:
+            _coalesced[0] += 1
+    if not leader:
+        # Share the result of the fetch already under way
+        flight[0].wait()
+        return flight[1]
     try:
-        # To stop limits of API calls during development, use forecast.txt if present instead of fetching
-        with open("forecast.txt") as f:
-            json = loads(f.read())
+        # It may have been fetched (and cached) just before we started (already counted as a miss)
+        flight[1] = None if fresh else _cache.peek(key)
+        if flight[1] is None:
+            flight[1] = _forecast(location, time)
+            if flight[1] is not None:
+                _cache.put(key, flight[1])
+                if _disk:
+                    _disk[0].put(key, flight[1])
+    finally:
+        # Cached before it's removed, so nobody fetches it again
+        with _in_flight_lock:
+            del _in_flight[key]
+        flight[0].set()
+    return flight[1]
+
+def _hour(data):
+    """
+    Get what we need from an hour (or the current conditions) of the forecast
+    :param data: The json for the hour
+    :return: Dictionary of the hour
+    """
+    return {'time': data["time"],
+            'temperature': data["temperature"],
+            'feelsLike': data["apparentTemperature"],
+            'summary': data["summary"],
+            'icon': data["icon"],
+            'windSpeed': data["windSpeed"],
+            # windBearing may not be defined if speed is 0
+            'windBearing': data.get("windBearing", 0),
+            }
+
+def _forecast(location, time):
+    """
+    Fetch the forecast for the day of a paricular location at a specific time
+    :param location: The (lat, lon) of location
+    :param time: The unix timestamp
+    :return: A dictionary of the day with the forecast for each hour (or None if there was a problem)
+    """
+    try:
+        json = _backend[0].fetch(location, time)
     except:
-        try:
-            json = _fetch(url)
-        except:
-            return
-    # Extract the pertinent data from the json
-    details = {'temperature': json["currently"]["temperature"],
-               'feelsLike': json["currently"]["apparentTemperature"],
-               'summary': json["currently"]["summary"],
-               'icon': json["currently"]["icon"],
-               'windSpeed': json["currently"]["windSpeed"],
-               # windBearing may not be defined if speed is 0
-               'windBearing': _direction(json["currently"].get("windBearing", 0)),
-               'windDirection': json["currently"].get("windBearing", 0),
-               'low': json["daily"]["data"][0]["temperatureMin"],
-               'high': json["daily"]["data"][0]["temperatureMax"],
-               'dailySummary': json["daily"]["data"][0]["summary"],
-               'sunrise': _get_time(json["daily"]["data"][0]["sunriseTime"]),
-               'sunset':  _get_time(json["daily"]["data"][0]["sunsetTime"]),
-               'time': _get_time(json["currently"]["time"]),
-               'latitude': location[0],
-               'longitude': location[1],
-               }
-    return details
+        return
+    # Extract the pertinent data from the json, the hourly forecasts cover the whole day
+    hours = dict((hour['time'], hour) for hour in map(_hour, json.get("hourly", {}).get("data", [])))
+    if not hours:
+        # No hourly forecasts, so at least the time asked for
+        hours[json["currently"]["time"]] = _hour(json["currently"])
+    day = {'hours': [hours[hour] for hour in sorted(hours)],
+           'low': json["daily"]["data"][0]["temperatureMin"],
+           'high': json["daily"]["data"][0]["temperatureMax"],
+           'dailySummary': json["daily"]["data"][0]["summary"],
+           'sunrise': _get_time(json["daily"]["data"][0]["sunriseTime"]),
+           'sunset':  _get_time(json["daily"]["data"][0]["sunsetTime"]),
+           }
+    return day
 
 
 
@@ -0,0 +1,283 @@
+"""
+Fast streaming reader for the GTFS stop_times.txt file (and the days each trip runs)
+
+stop_times.txt has one row for every stop of every trip (millions of rows for
+the whole of Victoria), so rather than a dictionary per row we find the columns
+we need once, and parse the times by slicing. Rows are grouped by trip as they
+are read, giving the stops and times of each trip.
+
+Large files are split into chunks (on trip boundaries) that are read by a pool
+of processes, and the trips from each chunk are merged by route.
+
+trips.txt gives the service of each trip and calendar.txt the days of the week
+each service runs, which are kept as a byte for each trip (bit 0 is Monday).
+"""
+import os
+import csv
+import sys
+import time
+import multiprocessing
+from array import array
+from operator import itemgetter
+
+# Unsigned 16 bit minutes after midnight (the same as the timetable)
+_TYPECODE = 'H'
+# Files smaller than this aren't worth starting processes for
+_PARALLEL_SIZE = 8 * 1024 * 1024
+# Every day of the week (bit 0 is Monday, the same as datetime.weekday())
+EVERY_DAY = 0x7f
+# The columns of calendar.txt, Monday first
+_WEEK = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+
+def skip_bom(f):
+    """
+    Skip the byte order mark (Unicode thing) if present
+    :param f: The binary file that we've opened
+    :return: The file is advanced past the byte order mark
+    """
+    if ord(f.read(1)) == 239:   # File starts with 3 bytes, the first being 239 for unicode
+        f.read(2)
+    else:
+        # We need to go back to the beginning since we read a byte that we didn't need to
+        f.seek(0)
+
+
+def columns(header, *names):
+    """
+    Find where the columns are
+    :param header: The first row of the file
+    :param names: The names of the columns we want
+    :return: A function that gets those columns from a row (as a tuple)
+    """
+    header = [name.strip() for name in header]
+    return itemgetter(*[header.index(name) for name in names])
+
+
+def trips_from(lines):
+    """
+    Read the trips from stop_times.txt
+    :param lines: The lines of the file (or the file, opened as binary and positioned at the header)
+    :return: Generator of (trip id, tuple of stop ids, array of times) for each trip
+    """
+    reader = csv.reader(lines)
+    fields = columns(next(reader), 'trip_id', 'arrival_time', 'stop_id')
+    # Each trip has an id, so initialize with none
+    trip = None
+    stops = []
+    times = array(_TYPECODE)
+    for row in reader:
+        trip_id, arrival, stop = fields(row)
+        # Started a new trip
+        if trip_id != trip:
+            if stops:
+                yield trip, tuple(stops), times
+                stops = []
+                times = array(_TYPECODE)
+            trip = trip_id
+        stops.append(int(stop))
+        # Minutes after midnight: the 2 digits before :ss are the minutes, everything before that is hours
+        times.append(int(arrival[:-6]) * 60 + int(arrival[-5:-3]))
+    # The last trip
+    if stops:
+        yield trip, tuple(stops), times
+
+
+def read_trips(path):
+    """
+    Read all the trips from a stop_times.txt file
+    :param path: The file name
+    :return: Generator of (trip id, tuple of stop ids, array of times) for each trip
+    """
+    with open(path, 'rb') as f:
+        skip_bom(f)
+        for trip in trips_from(f):
+            yield trip
+
+
+def read_services(trips_path, calendar_path):
+    """
+    Work out the days of the week each trip runs
+    :param trips_path: The trips.txt file name (trip id -> service id)
+    :param calendar_path: The calendar.txt file name (service id -> days of the week)
+    :return: Dictionary of trip id -> days (bit 0 is Monday) OR None if either file is missing
+    """
+    if not os.path.exists(trips_path) or not os.path.exists(calendar_path):
+        return
+    services = {}
+    with open(calendar_path, 'rb') as f:
+        skip_bom(f)
+        reader = csv.reader(f)
+        fields = columns(next(reader), 'service_id', *_WEEK)
+        for row in reader:
+            values = fields(row)
+            services[values[0]] = sum(1 << day for day, running in enumerate(values[1:]) if running.strip() == '1')
+    days = {}
+    with open(trips_path, 'rb') as f:
+        skip_bom(f)
+        reader = csv.reader(f)
+        fields = columns(next(reader), 'trip_id', 'service_id')
+        for row in reader:
+            trip, service = fields(row)
+            # Services only in calendar_dates.txt aren't understood, so assume they always run
+            days[trip] = services.get(service, EVERY_DAY)
+    return days
+
+
+def _trip_id(line, field):
+    """
+    Get the trip id from a line of the file
+    :param line: The line
+    :param field: Function that gets the trip id from a row
+    :return: The trip id
+    """
+    return field(next(csv.reader([line])))
+
+
+def chunks(path, count):
+    """
+    Split a stop_times.txt file into chunks that start at the beginning of a trip
+    :param path: The file name
+    :param count: How many chunks we want
+    :return: The header line, list of (start, end) byte offsets of each chunk
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        skip_bom(f)
+        header = f.readline()
+        field = columns(next(csv.reader([header])), 'trip_id')
+        boundaries = [f.tell()]
+        for chunk in range(1, count):
+            # Roughly where this chunk should start
+            offset = boundaries[0] + (size - boundaries[0]) * chunk // count
+            if offset <= boundaries[-1]:
+                continue
+            f.seek(offset)
+            # Skip the rest of the line we landed in
+            f.readline()
+            start = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            trip = _trip_id(line, field)
+            # Move forward to the first line of the next trip
+            while line and _trip_id(line, field) == trip:
+                start = f.tell()
+                line = f.readline()
+            if not line:
+                break
+            boundaries.append(start)
+    boundaries.append(size)
+    return header, [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def _group(trips, services=None):
+    """
+    Group trips by the stops they visit
+    :param trips: (trip id, stops, times) for each trip
+    :param services: Dictionary of trip id -> days it runs (None if every trip runs every day)
+    :return: Dictionary of tuple of stop ids -> (list of times for each trip, array of the days each trip runs)
+    """
+    routes = {}
+    for trip, stops, times in trips:
+        route = routes.get(stops)
+        if route is None:
+            route = routes[stops] = [], array('B')
+        route[0].append(times)
+        route[1].append(services.get(trip, EVERY_DAY) if services else EVERY_DAY)
+    return routes
+
+
+def _read_chunk(chunk):
+    """
+    Read one chunk of the file (in a worker process)
+    :param chunk: (file name, header line, start, end, services)
+    :return: Dictionary of tuple of stop ids -> times of all the trips one after another, days of each trip (as bytes)
+    """
+    path, header, start, end, services = chunk
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+    fragments = {}
+    for stops, (trips, days) in _group(trips_from([header] + lines), services).items():
+        times = array(_TYPECODE)
+        for trip in trips:
+            times.extend(trip)
+        # Bytes are much quicker to send back than lists of numbers
+        fragments[stops] = times.tostring(), days.tostring()
+    return fragments
+
+
+def read_routes(path, services=None, processes=None):
+    """
+    Read the trips from stop_times.txt, grouped by route
+    :param path: The file name
+    :param services: Dictionary of trip id -> days it runs, as returned by read_services (None for every day)
+    :param processes: How many processes to use (default is one for each cpu)
+    :return: Dictionary of tuple of stop ids -> (list of times for each trip, array of the days each trip runs)
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 2 or os.path.getsize(path) < _PARALLEL_SIZE:
+        return _group(read_trips(path), services)
+
+    header, offsets = chunks(path, processes)
+    pool = multiprocessing.Pool(processes)
+    try:
+        fragments = pool.map(_read_chunk, [(path, header, start, end, services) for start, end in offsets])
+    finally:
+        pool.close()
+        pool.join()
+
+    # Merge the routes from each chunk
+    routes = {}
+    for fragment in fragments:
+        for stops, (data, running) in fragment.items():
+            times = array(_TYPECODE)
+            times.fromstring(data)
+            trips, days = routes.setdefault(stops, ([], array('B')))
+            for start in range(0, len(times), len(stops)):
+                trips.append(times[start:start + len(stops)])
+            days.fromstring(running)
+    return routes
+
+
+def synthetic(path, rows, stops=20):
+    """
+    Write a made up stop_times.txt (for measuring how fast we can read it)
+    :param path: The file name to write
+    :param rows: About how many rows to write
+    :param stops: The number of stops on each trip
+    :return: None
+    """
+    with open(path, 'w') as f:
+        f.write('trip_id,arrival_time,departure_time,stop_id,stop_sequence,stop_headsign,'
+                'pickup_type,drop_off_type,shape_dist_traveled\n')
+        for trip in range(rows // stops):
+            start = 300 + trip % 1000
+            for sequence in range(stops):
+                minute = start + sequence * 3
+                f.write('"%d.T0.2-ALM-B-mjp-1.1.H","%02d:%02d:00","%02d:%02d:00","%d","%d","","0","0",""\n' % (
+                    trip, minute // 60, minute % 60, minute // 60, minute % 60, 19800 + (trip % 50) + sequence, sequence + 1))
+
+
+def benchmark(rows=2000000, processes=1):
+    """
+    Measure how many rows a second we can read
+    :param rows: The number of rows in the made up file
+    :param processes: How many processes to read it with
+    :return: rows per second
+    """
+    path = 'stop_times.benchmark.txt'
+    synthetic(path, rows)
+    try:
+        start = time.time()
+        count = sum(len(stops) * len(trips) for stops, (trips, days) in read_routes(path, None, processes).items())
+        return count / (time.time() - start)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    # python gtfs.py [rows [processes]]
+    print('%.0f rows/second' % benchmark(*[int(arg) for arg in sys.argv[1:]]))
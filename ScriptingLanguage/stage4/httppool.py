@@ -0,0 +1,142 @@
+"""
+HTTP client that keeps connections open between requests (keep-alive)
+
+Opening a connection to an https server takes a TCP and a TLS handshake, which
+is often longer than the request itself. Connections are kept in a pool for
+each host and reused. The pool has a maximum number of connections for each
+host (callers wait for one to be free) and every request has a timeout.
+
+A connection that has been idle may have been closed by the server, so if a
+reused connection fails before we get a response the request is sent again on
+a new connection.
+"""
+import time
+import socket
+import httplib
+import threading
+from urlparse import urlsplit
+
+# Errors that mean a connection has gone stale (the server closed it while it was idle)
+_STALE = (httplib.BadStatusLine, httplib.CannotSendRequest, httplib.ResponseNotReady, socket.error)
+
+
+class ConnectionPool(object):
+
+    def __init__(self, size=4, timeout=10.0):
+        """
+        Create an empty pool
+        :param size: The most connections to each host
+        :param timeout: How many seconds to wait for a connection, or for the server to respond
+        :return: None
+        """
+        self.size = size
+        self.timeout = timeout
+        # (scheme, host, port) -> list of idle connections
+        self._idle = {}
+        # (scheme, host, port) -> number of connections (idle or in use)
+        self._open = {}
+        self._available = threading.Condition(threading.Lock())
+        self.created = 0
+        self.reused = 0
+
+    def _acquire(self, host):
+        """
+        Get an idle connection to the host, or open a new one
+        :param host: (scheme, host, port)
+        :return: (connection, True if it has been used before)
+        """
+        deadline = time.time() + self.timeout
+        with self._available:
+            while True:
+                idle = self._idle.get(host)
+                if idle:
+                    self.reused += 1
+                    return idle.pop(), True
+                if self._open.get(host, 0) < self.size:
+                    self._open[host] = self._open.get(host, 0) + 1
+                    self.created += 1
+                    break
+                # Wait for another thread to finish with one
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise IOError("Timed out waiting for a connection to %s" % host[1])
+                self._available.wait(remaining)
+        scheme, name, port = host
+        factory = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        return factory(name, port, timeout=self.timeout), False
+
+    def _release(self, host, connection, keep):
+        """
+        Finished with a connection
+        :param host: (scheme, host, port)
+        :param connection: The connection
+        :param keep: Whether it can be used again (otherwise it is closed)
+        :return: None
+        """
+        if not keep:
+            connection.close()
+        with self._available:
+            if keep:
+                self._idle.setdefault(host, []).append(connection)
+            else:
+                self._open[host] -= 1
+            # The threads waiting may want other hosts, so wake them all
+            self._available.notify_all()
+
+    def get(self, url, headers=None):
+        """
+        Fetch a url
+        :param url: The http or https url
+        :param headers: Dictionary of extra request headers
+        :return: The body of the response
+        """
+        parts = urlsplit(url)
+        host = parts.scheme, parts.hostname, parts.port
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers or {})
+        headers.setdefault("Connection", "keep-alive")
+        while True:
+            connection, reused = self._acquire(host)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except _STALE as error:
+                self._release(host, connection, False)
+                # A timeout means the server is slow, not that the connection was stale
+                if reused and not isinstance(error, socket.timeout):
+                    # The server closed it while it was idle, try again with a new one
+                    continue
+                raise
+            except:
+                self._release(host, connection, False)
+                raise
+            # Keep the connection unless the server is closing it
+            self._release(host, connection, not response.will_close)
+            if response.status != 200:
+                raise IOError("HTTP %d %s fetching %s" % (response.status, response.reason, parts.hostname))
+            return body
+
+    def close(self):
+        """
+        Close the idle connections
+        :return: None
+        """
+        with self._available:
+            for host, idle in self._idle.items():
+                for connection in idle:
+                    connection.close()
+                self._open[host] -= len(idle)
+                del idle[:]
+            self._available.notify_all()
+
+    def stats(self):
+        """
+        How many connections have been opened and reused
+        :return: Dictionary of created, reused and idle
+        """
+        with self._available:
+            return {"created": self.created, "reused": self.reused,
+                    "idle": sum(len(idle) for idle in self._idle.values())}
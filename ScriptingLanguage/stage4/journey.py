@@ -0,0 +1,236 @@
+"""
+Round based earliest arrival journey planning (RAPTOR)
+
+Each round scans the routes through the stops that improved in the previous
+round, so round k finds the best journeys that use k trips (k - 1 transfers).
+Transfers are made at shared stops, a connecting trip has to leave after we
+arrive (the same rule as the direct route search). Given a day of the week, only
+the trips running that day are used (and routes with none are skipped).
+
+Profiles (every useful journey in a range of departure times) use a connection
+scan instead: every hop of every trip, scanned once from the latest departure.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from timetable import EVERY_DAY
+
+# The most trips we will consider in one journey
+MAX_ROUNDS = 6
+
+# Larger than any time after midnight
+_NEVER = 1 << 30
+
+
+def _queue(stations, marked, day=None):
+    """
+    Work out which routes need scanning and the first stop to scan them from
+    :param stations: Dictionary of stop id -> Station
+    :param marked: The stops that were improved in the last round
+    :param day: The day of the week (0 is Monday, None for any day)
+    :return: Dictionary of route -> first position to scan from
+    """
+    queue = {}
+    for stop in marked:
+        for route in stations[stop].routes:
+            # No trips that day
+            if not route.runs(day):
+                continue
+            position = route.position(stop)
+            # Only scan from the earliest marked stop on the route
+            if route not in queue or position < queue[route]:
+                queue[route] = position
+    return queue
+
+
+def earliest_arrival(stations, origin, time, target=None, rounds=MAX_ROUNDS, latest=None, day=None):
+    """
+    Find the earliest arrival at every stop reachable from origin leaving after time
+    :param stations: Dictionary of stop id -> Station (with the routes serving it)
+    :param origin: The stop id where the journey starts
+    :param time: The time we are leaving (minutes after midnight)
+    :param target: The stop id we want to get to (prunes the search), None for all stops
+    :param rounds: The maximum number of trips in a journey
+    :param latest: Ignore anything arriving after this time (minutes after midnight)
+    :param day: The day of the week (0 is Monday, None for trips on any day)
+    :return: (best, labels, parents) - best arrival for each stop, and the per round
+             arrivals and how they were reached (for building the journey)
+    """
+    # Best arrival time at each stop over all rounds
+    best = {origin: time}
+    # The arrivals found in each round (round 0 is just being at the origin)
+    labels = [{origin: time}]
+    # How each stop was reached in each round (route, boarding stop, boarding time)
+    parents = [{}]
+    # Nothing can arrive later than this and still be useful
+    limit = _NEVER if latest is None else latest + 1
+    marked = set([origin])
+
+    for k in range(1, rounds + 1):
+        # The arrival times from the previous rounds are used for boarding
+        previous = dict(best)
+        queue = _queue(stations, marked, day)
+        marked = set()
+        labels.append({})
+        parents.append({})
+
+        for route, first in queue.items():
+            # The trip we are currently on (None until we board one)
+            trip = None
+            board = None
+            for position in range(first, len(route.route)):
+                stop = route.route[position]
+                if trip is not None:
+                    arrival = route.time(trip, position)
+                    # Can't be better than what we have for the target either
+                    bound = min(best.get(stop, _NEVER), best.get(target, limit), limit)
+                    if arrival < bound:
+                        best[stop] = arrival
+                        labels[k][stop] = arrival
+                        parents[k][stop] = route, board, route.time(trip, board_position)
+                        marked.add(stop)
+                # Could we catch an earlier trip from this stop?
+                ready = previous.get(stop)
+                if ready is not None and (trip is None or ready < route.time(trip, position)):
+                    catch = route.next_trip(position, ready, day)
+                    if catch is not None and catch != trip:
+                        trip = catch
+                        board = stop
+                        board_position = position
+
+        # No improvements means more trips can't help
+        if not marked:
+            break
+
+    return best, labels, parents
+
+
+def journey(labels, parents, origin, destination):
+    """
+    Build the legs of the journey found by earliest_arrival
+    :param labels: The per round arrivals from earliest_arrival
+    :param parents: How each stop was reached in each round
+    :param origin: The stop id where the journey starts
+    :param destination: The stop id where the journey ends
+    :return: List of (from stop, to stop, departure time) OR None if not reachable
+    """
+    # Find the round with the earliest arrival (fewest trips if there's a tie)
+    arrivals = [(label[destination], k) for k, label in enumerate(labels) if destination in label]
+    if not arrivals or destination == origin:
+        return
+    arrival, k = min(arrivals)
+    legs = []
+    stop = destination
+    while stop != origin:
+        route, board, departure = parents[k][stop]
+        legs.append((board, stop, departure))
+        # Find the round where we reached the boarding stop in time to catch the trip
+        k -= 1
+        while board not in labels[k] or labels[k][board] >= departure:
+            k -= 1
+        stop = board
+    legs.reverse()
+    return legs
+
+
+def travel(stations, origin, destination, time, rounds=MAX_ROUNDS, latest=None, day=None):
+    """
+    Find the earliest arrival at destination leaving origin after time
+    :param stations: Dictionary of stop id -> Station
+    :param origin: Where are we starting from? (stop id)
+    :param destination: Where are we heading to? (stop id)
+    :param time: What time are we leaving? (minutes after midnight)
+    :param rounds: The maximum number of trips in a journey
+    :param latest: Only look for journeys arriving by this time (e.g. a known direct route)
+    :param day: The day of the week (0 is Monday, None for trips on any day)
+    :return: arrival time, [(from stop, to stop, departure time)] OR None if no route
+    """
+    best, labels, parents = earliest_arrival(stations, origin, time, destination, rounds, latest, day)
+    legs = journey(labels, parents, origin, destination)
+    if legs:
+        return best[destination], legs
+
+
+def connections(routes):
+    """
+    Every hop (from one stop to the next) of every trip, in order of departure
+    :param routes: The routes
+    :return: Arrays of (departure, arrival, from stop, to stop, trip number, days the trip runs)
+    """
+    departures = array('H')
+    arrivals = array('H')
+    froms = array('l')
+    tos = array('l')
+    trips = array('l')
+    days = array('B')
+    trip = 0
+    for route in routes:
+        for number in range(len(route.schedule)):
+            for position in range(len(route.route) - 1):
+                departures.append(route.time(number, position))
+                arrivals.append(route.time(number, position + 1))
+                froms.append(route.route[position])
+                tos.append(route.route[position + 1])
+                trips.append(trip)
+                days.append(route.schedule.days[number])
+            trip += 1
+    # Sort all the arrays by departure time
+    order = sorted(range(len(departures)), key=departures.__getitem__)
+    return tuple(array(column.typecode, [column[i] for i in order])
+                 for column in (departures, arrivals, froms, tos, trips, days))
+
+
+def profile(connections, origin, destination, start, end, latest=None, day=None):
+    """
+    Find every useful journey leaving in a range of times (the ones where leaving
+    earlier doesn't get you there any sooner) in a single scan of the connections
+    :param connections: As returned by connections()
+    :param origin: Where are we starting from? (stop id)
+    :param destination: Where are we heading to? (stop id)
+    :param start: The earliest we can leave (minutes after midnight)
+    :param end: The latest we want to leave (minutes after midnight)
+    :param latest: Don't bother with journeys arriving after this (e.g. the best journey leaving after end)
+    :param day: The day of the week (0 is Monday, None for trips on any day)
+    :return: List of (departure, arrival) in order of departure
+    """
+    departures, arrivals, froms, tos, trips, days = connections
+    if latest is None:
+        latest = _NEVER
+    # Only the trips with this day's bit set
+    mask = EVERY_DAY if day is None else 1 << day
+    # Earliest arrival at the destination from each trip (staying on it)
+    seated = {}
+    # For each stop, the useful (departure, arrival at destination) found so far, latest first.
+    # Departures are negated so they are in ascending order for bisect
+    profiles = {}
+    # From the last connection that could be useful back to the first one leaving in time
+    for i in range(bisect_right(departures, latest) - 1, bisect_left(departures, start) - 1, -1):
+        arrival = arrivals[i]
+        if arrival > latest or not days[i] & mask:
+            continue
+        # Get off here if this is the destination
+        best = arrival if tos[i] == destination else _NEVER
+        # Stay on the trip
+        best = min(best, seated.get(trips[i], _NEVER))
+        # Or change to a later journey from the next stop
+        later = profiles.get(tos[i])
+        if later:
+            position = bisect_left(later[0], -arrival)
+            if position:
+                best = min(best, later[1][position - 1])
+        if best == _NEVER:
+            continue
+        seated[trips[i]] = best
+        # Only useful if it gets there sooner than any later departure from this stop
+        departure = -departures[i]
+        negated, best_arrivals = profiles.setdefault(froms[i], ([], []))
+        if not best_arrivals or best < best_arrivals[-1]:
+            if negated and negated[-1] == departure:
+                best_arrivals[-1] = best
+            else:
+                negated.append(departure)
+                best_arrivals.append(best)
+    negated, best_arrivals = profiles.get(origin, ([], []))
+    # Leaving the origin after the end isn't in the range we want, but those journeys still rule out
+    # any in the range that don't get there sooner, so they are only left out now
+    return [(-departure, arrival) for departure, arrival in reversed(list(zip(negated, best_arrivals)))
+            if -departure <= end]
@@ -0,0 +1,101 @@
+"""
+Projection from latitude and longitude to pixels on the map
+
+The map only covers Melbourne, so an affine transform is close enough:
+
+    x = a * longitude + b * latitude + c
+    y = d * longitude + e * latitude + f
+
+The coefficients are a least squares fit to control points (stations whose
+position on the map is known, from closest.txt). Locations past the control
+points (where the fit can't be trusted, and the map may not reach) are put at the
+closest control point instead.
+"""
+from math import cos, radians
+import spatial
+
+
+def _solve(matrix, vector):
+    """
+    Solve a 3 x 3 system of linear equations (Gaussian elimination with partial pivoting)
+    :param matrix: 3 rows of 3 coefficients
+    :param vector: 3 values
+    :return: List of the 3 unknowns
+    """
+    rows = [list(row) + [value] for row, value in zip(matrix, vector)]
+    for column in range(3):
+        # Use the row with the largest value in this column, for accuracy
+        pivot = max(range(column, 3), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            raise ValueError("The control points are all in a line")
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(column + 1, 3):
+            scale = rows[row][column] / rows[column][column]
+            rows[row] = [value - scale * top for value, top in zip(rows[row], rows[column])]
+    # Back substitution
+    result = [0.0] * 3
+    for row in range(2, -1, -1):
+        total = rows[row][3] - sum(rows[row][column] * result[column] for column in range(row + 1, 3))
+        result[row] = total / rows[row][row]
+    return result
+
+
+def fit(controls):
+    """
+    Fit the projection to the control points
+    :param controls: List of ((latitude, longitude), (x, y)) for each point
+    :return: ((a, b, c), (d, e, f)) the coefficients for x and y
+    """
+    if len(controls) < 3:
+        raise ValueError("Need at least 3 control points, there are %d" % len(controls))
+    # Centre the locations, so the sums don't lose precision
+    count = float(len(controls))
+    lat0 = sum(location[0] for location, pixel in controls) / count
+    lon0 = sum(location[1] for location, pixel in controls) / count
+    # The normal equations (A'A) p = A'b, where each row of A is (longitude, latitude, 1)
+    rows = [(lon - lon0, lat - lat0, 1.0) for (lat, lon), pixel in controls]
+    matrix = [[sum(row[i] * row[j] for row in rows) for j in range(3)] for i in range(3)]
+    coefficients = []
+    for axis in range(2):
+        vector = [sum(row[i] * pixel[axis] for row, (location, pixel) in zip(rows, controls)) for i in range(3)]
+        a, b, c = _solve(matrix, vector)
+        # Undo the centring
+        coefficients.append((a, b, c - a * lon0 - b * lat0))
+    return tuple(coefficients)
+
+
+def project(coefficients, locations):
+    """
+    Convert locations to pixels
+    :param coefficients: As returned by fit
+    :param locations: List of (latitude, longitude)
+    :return: List of (x, y) pixels (rounded to the nearest pixel)
+    """
+    (a, b, c), (d, e, f) = coefficients
+    return [(int(round(a * lon + b * lat + c)), int(round(d * lon + e * lat + f))) for lat, lon in locations]
+
+
+def locate(coefficients, controls, locations, size=None):
+    """
+    Convert locations to pixels, keeping them on the map
+    :param coefficients: As returned by fit
+    :param controls: The control points the coefficients were fitted to
+    :param locations: List of (latitude, longitude)
+    :param size: (width, height) of the map in pixels (None if the pixels can be anywhere)
+    :return: List of (x, y) pixels
+    """
+    lats = [lat for (lat, lon), pixel in controls]
+    lons = [lon for (lat, lon), pixel in controls]
+    latitude = sum(lats) / float(len(lats))
+    nearest = spatial.Grid(controls, scale=cos(radians(latitude)))
+    pixels = []
+    for location, pixel in zip(locations, project(coefficients, locations)):
+        lat, lon = location
+        if not (min(lats) <= lat <= max(lats) and min(lons) <= lon <= max(lons)):
+            # Past the control points the fit can't be trusted (and the map may not go that far)
+            pixel = nearest.nearest(lat, lon)
+        if size:
+            # Keep it on the map
+            pixel = min(max(pixel[0], 0), size[0] - 1), min(max(pixel[1], 0), size[1] - 1)
+        pixels.append(tuple(pixel))
+    return pixels
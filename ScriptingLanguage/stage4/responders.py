@@ -1,6 +1,21 @@
 #!/usr/bin/python
 
+import json
 import stage2
+import forecast
+import warmer
+
+# The most stations nearby.json will list
+_NEARBY = 50
+# The most names complete.json will suggest
+_COMPLETE = 20
+# The longest reachable.json will look (minutes)
+_BUDGET = 6 * 60
+
+
+class BadRequest(ValueError):
+    # Something wrong with the query (the web server answers 400 with the message as json)
+    pass
 
 
 def header():
@@ -80,20 +95,34 @@ def initialPage():
     return header() + footer()
 
 
+def strip(hours):
+    """
+    The weather for the next few hours, side by side
+    :param hours: List of dictionaries with details of the weather for each hour
+    :return: Table with the time, icon and temperature for each hour
+    """
+    cells = "".join("""<td class="text-center">{time}<br/><i class="wi wi-{icon}"></i><br/>{temperature}<i class="wi wi-celsius"></i></td>""".format(**hour)
+                    for hour in hours)
+    return """<table class="table table-condensed"><tr>%s</tr></table>""" % cells
+
+
 def details(weather):
     """
     Content for the weather part of displau
     :param weather: Dictionary with details of the weather
     :return: The web page without any results
     """
+    weather = dict(weather, strip=strip(weather.get("hourly", [])))
     return """<table class="forecast bg-success"><tr><th colspan="2" class="text-center lead">Weather for {location} at {time}<th></tr>
-    <tr><td>Temp: {temperature}<i class="wi wi-celsius"></i> Feels Like: {feelsLike}<i class="wi wi-celsius"></i></td><td rowspan="9"><img src="map.gif?{id},{destination}" width="600" height="371" class="img-rounded"/><td></tr>
+    <tr><td>Temp: {temperature}<i class="wi wi-celsius"></i> Feels Like: {feelsLike}<i class="wi wi-celsius"></i></td><td rowspan="11"><img src="map.gif?{id},{destination}" width="600" height="371" class="img-rounded"/><td></tr>
     <tr><td>Low: {low}<i class="wi wi-celsius"></i> High: {high}<i class="wi wi-celsius"></i></td></tr>
     <tr><td>Sunrise <i class="wi wi-sunrise"></i>: {sunrise} Sunset <i class="wi wi-sunset"></i>: {sunset}</td></tr>
     <tr><td>Wind: {windSpeed} kph from {windBearing} <i class="wi wi-wind.towards-{windDirection}-deg"></i></td></tr>
     <tr><td>Summary <i class="wi wi-{icon}"></i>: {summary}</td></tr>
+    <tr><td>{strip}</td></tr>
     <tr><td></td></tr>
     <tr><td>Arriving at {destination_station} at {arrive}</td></tr>
+    <tr><td>Weather on arrival <i class="wi wi-{arrivalIcon}"></i>: {arrivalTemperature}<i class="wi wi-celsius"></i> {arrivalSummary}</td></tr>
     <tr><td>Route:</td></tr>
     <tr><td>{route}</td></tr>
     <tr><td>&nbsp;</td><td>&nbsp;</td></tr>
@@ -120,11 +149,12 @@ def respondToSubmit(formData):
         # If today is specified, then assume current time if no time is mentioned
         if args[-1] == "Today":
             args[-1] = "Now"
-    # Process all the command line
-    weather = stage2.process(args)
-    if "error" not in weather:
-        # Fill in the details from the forecast
-        stage2.route(formData["stationName"], formData["destination"], weather)
+    # Process all the command line, find the route and get the weather at both ends (at the same time)
+    weather = stage2.plan(args, formData["destination"])
+    if not weather:
+        # Couldn't get the forecast
+        data += '<p class="bg-danger lead">Problem fetching the weather</p>'
+    elif "error" not in weather:
         data += '<p class="bg-success lead">%s</p><div class="row">&nbsp;</div>' % details(weather)
     else:
         # Fill in error message
@@ -133,3 +163,132 @@ def respondToSubmit(formData):
     data += footer()
 
     return data
+
+
+# this is suitable for a GET of json - it has a single parameter which is
+# a dictionary of values from the query string.
+
+def ready(query):
+    """
+    Readiness probe, has the timetable finished loading?
+    :param query: The query string parameters (not used)
+    :return: json with ready true or false, the error if the timetable couldn't be loaded (and how the
+             journey and forecast caches, and the warmer, are doing)
+    """
+    return json.dumps({"ready": stage2.ready(), "error": stage2.failure(), "journeys": stage2.cache_stats(),
+                       "forecasts": forecast.cache_stats(), "warmer": warmer.stats()})
+
+
+def matrix(query):
+    """
+    Travel matrix, the earliest arrival between every pair of stations
+    :param query: stations (comma separated, default is all of them), time (default is now) and day (default is today)
+    :return: json with the stations, time and arrivals (a row for each origin, minutes after midnight or null)
+    """
+    names = query["stations"].split(",") if query.get("stations") else stage2.station_names(aka=False)
+    known = set(stage2.station_names())
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        return json.dumps({"error": "Unable to find a station called %s" % unknown[0]})
+    time = stage2.minutes(query.get("time", "now"))
+    if time is None:
+        return json.dumps({"error": "%s is not a valid time" % query["time"]})
+    day = stage2.weekday(query.get("day", "today"))
+    if day is None:
+        return json.dumps({"error": "I don't understand %s" % query["day"]})
+    if not stage2.wait():
+        return json.dumps({"error": stage2.failure()})
+    arrivals = stage2.travel_matrix(names, time, day=day)
+    # No spaces, the matrix can be large
+    return json.dumps({"stations": names, "time": "%02d:%02d" % (time // 60, time % 60), "arrivals": arrivals},
+                      separators=(",", ":"))
+
+
+def profile(query):
+    """
+    Every useful journey between two stations leaving in a range of times
+    :param query: origin, destination, start and end (times, e.g. 7:00am and 9:00am) and day (default is today)
+    :return: json with the origin and destination names and the journeys as [departure, arrival] (hh:mm)
+    """
+    stations = []
+    for end in ("origin", "destination"):
+        station = stage2.find_station(query.get(end, ""))
+        if not station:
+            return json.dumps({"error": "Unable to find a station called %s" % query.get(end)})
+        stations.append(station)
+    start = stage2.minutes(query.get("start", "now"))
+    end = stage2.minutes(query.get("end", ""))
+    if start is None or end is None:
+        return json.dumps({"error": "Please give a start and end time"})
+    day = stage2.weekday(query.get("day", "today"))
+    if day is None:
+        return json.dumps({"error": "I don't understand %s" % query["day"]})
+    if not stage2.wait():
+        return json.dumps({"error": stage2.failure()})
+    journeys = stage2.profile(stations[0].name, stations[1].name, start, end, day)
+    return json.dumps({"origin": stations[0].name, "destination": stations[1].name,
+                       "journeys": [["%02d:%02d" % (time // 60, time % 60) for time in journey] for journey in journeys]})
+
+
+def nearby(query):
+    """
+    The stations closest to a location
+    :param query: lat and lon (degrees) and k (how many stations, default 5)
+    :return: json with the stations (name, id and distance in kilometres), closest first
+    """
+    try:
+        lat = float(query["lat"])
+        lon = float(query["lon"])
+        count = int(query.get("k", 5))
+    except (KeyError, ValueError):
+        return json.dumps({"error": "Please give a lat, lon and k"})
+    if not -90 <= lat <= 90 or not -180 <= lon <= 180 or count < 1:
+        return json.dumps({"error": "Please give a lat, lon and k"})
+    # Don't list every station
+    count = min(count, _NEARBY)
+    return json.dumps({"stations": [{"name": station.name, "id": station.id, "distance": round(distance, 3)}
+                                    for station, distance in stage2.nearby(lat, lon, count)]})
+
+
+def complete(query):
+    """
+    Autocomplete station names
+    :param query: q (what has been typed so far) and limit (how many names, default 10)
+    :return: json with the names (station names or aka names), the best matches first
+    """
+    try:
+        # At least one name, and no more than _COMPLETE
+        limit = max(1, min(int(query.get("limit", 10)), _COMPLETE))
+    except ValueError:
+        raise BadRequest("%s is not a number" % query["limit"])
+    return json.dumps({"names": stage2.complete(query.get("q", ""), limit)})
+
+
+def reachable(query):
+    """
+    Everywhere that can be reached from a station within a number of minutes
+    :param query: origin, time (default is now), minutes (default 30) and day (default is today)
+    :return: json with the stations reached (name, id, arrival time hh:mm and minutes taken), earliest first
+    """
+    origin = stage2.find_station(query.get("origin", ""))
+    if not origin:
+        return json.dumps({"error": "Unable to find a station called %s" % query.get("origin")})
+    time = stage2.minutes(query.get("time", "now"))
+    if time is None:
+        return json.dumps({"error": "%s is not a valid time" % query["time"]})
+    try:
+        budget = int(query.get("minutes", 30))
+    except ValueError:
+        budget = -1
+    if not 0 <= budget <= _BUDGET:
+        return json.dumps({"error": "Please give the minutes (up to %d)" % _BUDGET})
+    day = stage2.weekday(query.get("day", "today"))
+    if day is None:
+        return json.dumps({"error": "I don't understand %s" % query["day"]})
+    if not stage2.wait():
+        return json.dumps({"error": stage2.failure()})
+    stations = stage2.reachable(origin.name, time, budget, day)
+    return json.dumps({"origin": origin.name, "time": "%02d:%02d" % (time // 60, time % 60),
+                       "stations": [{"name": station.name, "id": station.id,
+                                     "arrive": "%02d:%02d" % (arrival // 60, arrival % 60), "minutes": arrival - time}
+                                    for station, arrival in stations]})
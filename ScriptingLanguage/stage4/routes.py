@@ -13,7 +13,13 @@
 def routes():
 	return (('get', '/', 'responders::initialPage'),      
 			('post', '/', 'responders::respondToSubmit'),
-			('post', '/processRequest', 'responders::respondToSubmit')
+			('post', '/processRequest', 'responders::respondToSubmit'),
+			('get', '/ready.json', 'responders::ready'),
+			('get', '/matrix.json', 'responders::matrix'),
+			('get', '/profile.json', 'responders::profile'),
+			('get', '/nearby.json', 'responders::nearby'),
+			('get', '/complete.json', 'responders::complete'),
+			('get', '/reachable.json', 'responders::reachable')
 			)
 
 
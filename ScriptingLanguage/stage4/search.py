@@ -0,0 +1,158 @@
+"""
+Search index of names (e.g. station names), for autocomplete
+
+Names are normalised (lower case, letters and digits only) and every word of
+each name starts a key ("melbourne central" and "central"), kept as a sorted
+list so the keys starting with what has been typed are found with a binary
+search.
+
+Typos are handled with symmetric deletes: every key prefix is also stored with
+each one of its letters deleted, so a query that is one edit (a wrong, missing,
+extra or swapped letter) away from the start of a name meets it in a dictionary
+lookup rather than comparing against every name.
+"""
+import re
+from bisect import bisect_left
+
+# Anything that isn't a letter or a digit separates words
+_SEPARATORS = re.compile(r"[^a-z0-9]+")
+# Queries shorter than this are too short to guess at typos
+_FUZZY_LENGTH = 3
+
+# How good a match is (lower is better)
+_NAME = 0
+_WORD = 1
+_TYPO = 2
+
+
+def normalise(text):
+    """
+    Normalise text for matching
+    :param text: The text
+    :return: Lower case words separated by single spaces
+    """
+    return " ".join(_SEPARATORS.split(text.lower())).strip()
+
+
+def _deletes(word):
+    """
+    Every way of deleting one letter from a word
+    :param word: The word
+    :return: Set of the words with one letter deleted
+    """
+    return set(word[:i] + word[i + 1:] for i in range(len(word)))
+
+
+def _distance(a, b):
+    """
+    Edit distance, counting swapping two letters next to each other as one edit
+    :param a: The first word
+    :param b: The second word
+    :return: The number of edits to turn a into b
+    """
+    previous = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, row = previous, row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+    return row[-1]
+
+
+class Index(object):
+
+    def __init__(self, names):
+        """
+        Build the index
+        :param names: Dictionary of name -> value (e.g. station name or aka -> station name)
+        :return: None
+        """
+        self.names = dict(names)
+        # (key, whether it is the start of the name, name), sorted by key
+        keys = []
+        # The normalised names, for exact matches
+        self.exact = {}
+        for name in self.names:
+            normal = normalise(name)
+            self.exact.setdefault(normal, name)
+            words = normal.split(" ")
+            for word in range(len(words)):
+                keys.append((" ".join(words[word:]), word > 0, name))
+        keys.sort()
+        self.keys = keys
+        # Just the keys, for bisect
+        self.sorted = [key for key, inside, name in keys]
+        # Each key prefix, and each with a letter deleted -> the names starting with that prefix
+        self.deletes = {}
+        for key, inside, name in keys:
+            for length in range(_FUZZY_LENGTH - 1, len(key) + 1):
+                prefix = key[:length]
+                for variant in _deletes(prefix) | set([prefix]):
+                    self.deletes.setdefault(variant, set()).add((prefix, name))
+
+    def __len__(self):
+        """
+        The number of names
+        :return: The number of names in the index
+        """
+        return len(self.names)
+
+    def _prefixed(self, query):
+        """
+        Find the keys starting with the query
+        :param query: The normalised query
+        :return: Generator of (key, whether it is the start of the name, name)
+        """
+        for position in range(bisect_left(self.sorted, query), len(self.sorted)):
+            if not self.sorted[position].startswith(query):
+                break
+            yield self.keys[position]
+
+    def _typos(self, query):
+        """
+        Find the names that start with something one edit away from the query
+        :param query: The normalised query
+        :return: Set of names
+        """
+        candidates = set()
+        for variant in _deletes(query) | set([query]):
+            candidates.update(self.deletes.get(variant, ()))
+        return set(name for prefix, name in candidates if _distance(query, prefix) <= 1)
+
+    def search(self, text, limit=10):
+        """
+        Find the names that best match what has been typed
+        :param text: The start of a name (or of any word in the name), can have a typo
+        :param limit: The most names to return
+        :return: List of names, the best matches first (the start of the name, then
+                 the start of a word in the name, then typos, alphabetical within those)
+        """
+        query = normalise(text)
+        if not query:
+            return []
+        matches = {}
+        for key, inside, name in self._prefixed(query):
+            quality = _WORD if inside else _NAME
+            matches[name] = min(matches.get(name, quality), quality)
+        if len(matches) < limit and len(query) >= _FUZZY_LENGTH:
+            for name in self._typos(query):
+                matches.setdefault(name, _TYPO)
+        return sorted(matches, key=lambda name: (matches[name], name))[:limit]
+
+    def find(self, text):
+        """
+        Find the name that was meant (ignoring case and punctuation, or with one typo if that's not ambiguous)
+        :param text: The name
+        :return: The value for the name OR None if there isn't one name that matches
+        """
+        query = normalise(text)
+        name = self.exact.get(query)
+        if name is None and len(query) >= _FUZZY_LENGTH:
+            # Only the whole name with a typo, not just the start of one
+            names = [typo for typo in self._typos(query) if _distance(query, normalise(typo)) <= 1]
+            if len(names) == 1:
+                name = names[0]
+        if name is not None:
+            return self.names[name]
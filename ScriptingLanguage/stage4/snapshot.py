@@ -0,0 +1,143 @@
+"""
+Compiled binary snapshot of the timetable
+
+Parsing stop_times.txt is slow, so the parsed stations and routes are written to
+a single file that can be memory mapped when the program starts. The file is:
+
+    header  - magic, format version, length of the index
+    index   - marshal of the source signature, stations, names, closest and the
+              routes (stops, number of trips, offset of the times, fifo)
+    times   - the columns of each route's timetable followed by the days each
+              trip runs (a byte per trip), one route after another
+
+The signature records the size and modification time of the source files, so
+the snapshot is ignored (and rebuilt) when any of them change.
+"""
+import os
+import sys
+import mmap
+import marshal
+import struct
+from array import array
+
+# Change this whenever the layout of the snapshot changes
+VERSION = 2
+
+_MAGIC = b"MWTT"
+# Magic, version, length of the index
+_HEADER = struct.Struct("<4sII")
+# The times are unsigned 16 bit minutes after midnight
+_TYPECODE = "H"
+_ITEMSIZE = array(_TYPECODE).itemsize
+
+
+def signature(sources):
+    """
+    Describe the source files, so we know when they have changed
+    :param sources: List of file names
+    :return: List of (file name, size, modification time), size and time are None if missing
+    """
+    result = []
+    for source in sources:
+        try:
+            info = os.stat(source)
+            result.append((source, info.st_size, int(info.st_mtime)))
+        except OSError:
+            result.append((source, None, None))
+    # marshal may change between python versions, so include that too
+    return [tuple(sys.version_info[:2])] + result
+
+
+def write(path, sources, stations, names, closest, routes, signed=None):
+    """
+    Write the snapshot (to a temporary file first, so readers never see half a file)
+    :param path: The file name of the snapshot
+    :param sources: The files the snapshot was built from
+    :param stations: List of (name, location, id, aka) for each station
+    :param names: Dictionary of station name (or aka) -> station id
+    :param closest: Dictionary of station name -> x, y on the map
+    :param routes: List of (stops, columns, days, fifo) for each route
+    :param signed: The signature of the sources when they were read (None for now), so changes made
+                   since then mean the snapshot is out of date
+    :return: True if the snapshot was written
+    """
+    if signed is None:
+        signed = signature(sources)
+    table = []
+    offset = 0
+    for stops, columns, days, fifo in routes:
+        trips = len(days)
+        table.append((stops, trips, offset, fifo))
+        offset += trips * len(stops) * _ITEMSIZE + trips
+    index = marshal.dumps((signed, stations, names, closest, table))
+
+    # Each process uses its own temporary file in case they compile at the same time
+    temporary = "%s.%d" % (path, os.getpid())
+    try:
+        with open(temporary, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, VERSION, len(index)))
+            f.write(index)
+            for stops, columns, days, fifo in routes:
+                for column in columns:
+                    f.write(column.tostring())
+                f.write(days.tostring())
+        # Replace any previous snapshot (rename is atomic, but windows won't replace a file)
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(temporary, path)
+        return True
+    except (IOError, OSError):
+        # We can still run without a snapshot (e.g. read only directory)
+        return False
+    finally:
+        # Don't leave half a snapshot behind, whatever stopped us (it's gone if it was renamed)
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def read(path, sources):
+    """
+    Read the snapshot if it is up to date with the source files
+    :param path: The file name of the snapshot
+    :param sources: The files the snapshot should have been built from
+    :return: (stations, names, closest, routes) as passed to write OR None if missing or out of date
+    """
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+        # Empty file
+        f.close()
+        return
+    try:
+        magic, version, length = _HEADER.unpack(data[:_HEADER.size])
+        if magic != _MAGIC or version != VERSION:
+            return
+        start = _HEADER.size + length
+        source, stations, names, closest, table = marshal.loads(data[_HEADER.size:start])
+        if source != signature(sources):
+            return
+        routes = []
+        for stops, trips, offset, fifo in table:
+            columns = []
+            # Each column is the times of every trip at one stop
+            size = trips * _ITEMSIZE
+            for position in range(len(stops)):
+                column = array(_TYPECODE)
+                column.fromstring(data[start + offset:start + offset + size])
+                columns.append(column)
+                offset += size
+            # One byte for each trip
+            days = array("B")
+            days.fromstring(data[start + offset:start + offset + trips])
+            routes.append((stops, columns, days, fifo))
+        return stations, names, closest, routes
+    except (struct.error, ValueError, EOFError, TypeError):
+        # Corrupt snapshot, it will be rebuilt
+        return
+    finally:
+        data.close()
+        f.close()
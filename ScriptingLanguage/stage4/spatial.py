@@ -0,0 +1,144 @@
+"""
+Grid index of points (e.g. stations) for finding the nearest one quickly
+
+The points are put into square cells of latitude and longitude. A search looks
+at the cell the location is in, then the rings of cells around it, stopping when
+the next ring can't be any closer than the best found so far. The index isn't
+changed after it is built, so it can be used by several threads at once.
+
+Longitudes can be scaled (by the cosine of the latitude) so that the cells are
+square on the ground rather than in degrees, then the closest in the index is
+also the closest by great circle distance (near enough over a city).
+"""
+import heapq
+from math import asin, cos, radians, sin, sqrt
+
+# Mean radius of the earth in kilometres
+EARTH_RADIUS = 6371.0088
+
+
+def distance(start, end):
+    """
+    Great circle distance (haversine formula)
+    :param start: (latitude, longitude)
+    :param end: (latitude, longitude)
+    :return: The distance in kilometres
+    """
+    lat1, lon1 = radians(start[0]), radians(start[1])
+    lat2, lon2 = radians(end[0]), radians(end[1])
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+
+class Grid(object):
+
+    def __init__(self, points, size=None, scale=1.0):
+        """
+        Build the index
+        :param points: List of ((latitude, longitude), item) for each point
+        :param size: The width of a cell in degrees (default gives about one point per cell)
+        :param scale: Multiply the longitudes by this (e.g. cos(latitude) for distances on the ground)
+        :return: None
+        """
+        self.points = list(points)
+        if not self.points:
+            raise ValueError("Can't build an index without any points")
+        self.scale = scale
+        lats = [location[0] for location, item in self.points]
+        lons = [location[1] * scale for location, item in self.points]
+        if size is None:
+            # Spread the points over about as many cells as there are points
+            size = max(max(lats) - min(lats), max(lons) - min(lons)) / sqrt(len(self.points)) or 1.0
+        self.size = size
+        # Dictionary of (row, column) -> list of (latitude, longitude, item)
+        self.cells = {}
+        for (lat, lon), item in self.points:
+            lon *= scale
+            self.cells.setdefault(self._cell(lat, lon), []).append((lat, lon, item))
+        rows = [row for row, column in self.cells]
+        columns = [column for row, column in self.cells]
+        # The cells that have points in them are all inside these
+        self.bounds = min(rows), max(rows), min(columns), max(columns)
+
+    def __len__(self):
+        """
+        The number of points
+        :return: The number of points in the index
+        """
+        return len(self.points)
+
+    def _cell(self, lat, lon):
+        """
+        Which cell is a location in?
+        :param lat: The latitude
+        :param lon: The longitude
+        :return: (row, column)
+        """
+        return int(lat // self.size), int(lon // self.size)
+
+    def _ring(self, row, column, ring):
+        """
+        The cells a number of cells away from a cell (the edge of the square around it)
+        :param row: The row of the centre cell
+        :param column: The column of the centre cell
+        :param ring: How many cells away (0 is just the centre)
+        :return: Generator of the list of points in each cell (empty cells are skipped)
+        """
+        top, bottom, left, right = self.bounds
+        if ring == 0:
+            cells = [(row, column)]
+        else:
+            # Only the part of the ring inside the bounds (the rest is empty, and far from here it's most of it)
+            rows = range(max(row - ring, top), min(row + ring, bottom) + 1)
+            columns = range(max(column - ring + 1, left), min(column + ring - 1, right) + 1)
+            # The columns at each side, then the rows at the top and bottom (without the corners again)
+            cells = [(each, column + side) for side in (-ring, ring) if left <= column + side <= right for each in rows]
+            cells += [(row + side, each) for side in (-ring, ring) if top <= row + side <= bottom for each in columns]
+        for cell in cells:
+            points = self.cells.get(cell)
+            if points:
+                yield points
+
+    def closest(self, lat, lon, count):
+        """
+        Find the nearest points (by the difference in latitude and scaled longitude, like a flat map)
+        :param lat: The latitude
+        :param lon: The longitude
+        :param count: How many points we want
+        :return: List of (squared distance in degrees, item), nearest first
+        """
+        lon *= self.scale
+        row, column = self._cell(lat, lon)
+        top, bottom, left, right = self.bounds
+        # Past this many rings there are no more cells with points
+        last = max(abs(row - top), abs(row - bottom), abs(column - left), abs(column - right))
+        # The nearest so far, as a heap with the furthest of them on top (the distances are negated)
+        best = []
+        # Closer than this many rings there are no cells with points either (when the location is outside the bounds)
+        ring = max(0, top - row, row - bottom, left - column, column - right)
+        while ring <= last:
+            for points in self._ring(row, column, ring):
+                for point_lat, point_lon, item in points:
+                    lat_diff = point_lat - lat
+                    lon_diff = point_lon - lon
+                    # We only care about the order, so we don't need to square root
+                    squared = lat_diff * lat_diff + lon_diff * lon_diff
+                    if len(best) < count:
+                        heapq.heappush(best, (-squared, id(item), item))
+                    elif squared < -best[0][0]:
+                        heapq.heapreplace(best, (-squared, id(item), item))
+            # Any point in the next ring is at least this far away
+            reach = ring * self.size
+            if len(best) == count and -best[0][0] <= reach * reach:
+                break
+            ring += 1
+        return sorted((-squared, item) for squared, key, item in best)
+
+    def nearest(self, lat, lon):
+        """
+        Find the nearest point (by the difference in latitude and scaled longitude, like a flat map)
+        :param lat: The latitude
+        :param lon: The longitude
+        :return: The item of the nearest point
+        """
+        return self.closest(lat, lon, 1)[0][1]
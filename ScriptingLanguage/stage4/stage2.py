@@ -1,12 +1,39 @@
 import sys, os, re
-from forecast import forecast
+import struct
+import threading
+import multiprocessing
+import gtfs
+import journey
+import snapshot
+import spatial
+import projection
+import search
+from cache import RangeCache
+from timetable import Timetable, runs
+from forecast import forecast, forecasts, hourly, snap
+from gtfs import skip_bom
 from csv import DictReader
+from collections import Counter
 from datetime import datetime, timedelta
 from time import mktime
+from math import cos, radians
 
 _HMT = re.compile(r"^(\d+):(\d+)($|[ap]m$)")
 _DAYS = {'mon':1, 'tue':2, 'wed':3, 'thu':4, 'fri':5, 'sat':6, 'sun':7,
         'tod':-1, 'now':-1, 'tom':-2, 'nex':-8}
+# The map the stations are drawn on
+_MAP = os.path.join("assets", "map.gif")
+# The compiled timetable, and the files it is compiled from (the stations, then the routes)
+_SNAPSHOT = "timetable.snapshot"
+_STATION_SOURCES = ["closest.txt", os.path.join("google_transit", "stops.txt")]
+_ROUTE_SOURCES = [os.path.join("google_transit", name) for name in ("stop_times.txt", "trips.txt", "calendar.txt")]
+_SOURCES = _STATION_SOURCES + _ROUTE_SOURCES
+# How long (seconds) a journey query waits for the timetable to finish loading
+_WARM_UP = 5
+# Travel matrices with fewer origins than this aren't worth sharing between processes
+_PARALLEL_ORIGINS = 16
+# The most journeys to remember (each one covers a range of departure times)
+_JOURNEY_CACHE = 10000
 
 def format(start, end, time):
     return "%s to %s %02d:%02d" % (_stop_ids[start].name, _stop_ids[end].name, time // 60, time % 60)
@@ -27,6 +54,8 @@ class Station(object):
         self.id = id
         self.aka = aka
         self.routes = []
+        # Index of destination stop id -> routes that go there from this station
+        self.destinations = {}
 
     def __str__(self):
         """
@@ -42,38 +71,85 @@ class Station(object):
         :return: None
         """
         self.routes.append(route)
+        # Index the route by every stop it goes to after this one
+        for stop in set(route.route[route.position(self.id) + 1:]):
+            self.destinations.setdefault(stop, []).append(route)
 
-    def travel(self, destination, time):
+    def direct(self, destination, time, day=None):
+        """
+        Find the earliest arrival at destination without changing
+        :param destination: Where to?
+        :param time: What time are we leaving?
+        :param day: The day of the week (0 is Monday, None for trips on any day)
+        :return: Time of arrival, path taken OR None if no direct route
+        """
+        best = None
+        # Only the routes that go to the destination from here
+        for route in self.destinations.get(destination.id, ()):
+            directions = route.travel(self.id, destination.id, time, day)
+            if directions and (not best or directions[0] < best[0]):
+                best = directions
+        return best
+
+    def journey(self, destination, time, day=None):
+        """
+        Find the earliest arrival at destination leaving after time (remembering the answer)
+        :param destination: Where to?
+        :param time: What time are we leaving?
+        :param day: The day of the week (0 is Monday, None for trips on any day)
+        :return: Time of arrival, path taken OR None if no route
+        """
+        # Make sure the routes have loaded (no journeys without them, and nothing to remember)
+        if not wait():
+            return
+        key = self.id, destination.id, day
+        directions = _journeys.get(key, time)
+        if directions is None:
+            # A direct route (if there is one) limits how far we need to search
+            direct = self.direct(destination, time, day)
+            latest = direct[0] if direct else None
+            # Search the timetable, changing trains at shared stops where needed
+            directions = journey.travel(_stop_ids, self.id, destination.id, time, latest=latest, day=day)
+            # Leaving any time before the first train gives the same answer (nothing else
+            # leaves in between and that journey is still there), and if there's no journey
+            # then leaving later won't help
+            end = directions[1][0][2] - 1 if directions else None
+            _journeys.put(key, time, end, directions or ())
+        return directions or None
+
+    def travel(self, destination, time, day=None):
         """
         Find a route to destination starting after time
         :param destination: Where to?
         :param time: What time are we leaving?
+        :param day: The day of the week (0 is Monday, None for trips on any day)
         :return: Textual description, Time of Arrival
         """
-        arrival = None
-        best = None
-        # Go through all the routes for this station
-        for route in self.routes:
-            # Get a route from this station to the destination
-            directions = route.travel(self.id, destination.id, time)
-            # We found a route
-            if directions:
-                # If it was the first one, or arrives earlier then update the best
-                if not arrival or directions[0] < arrival:
-                    arrival, best = directions
-
-        # If we have an arrival time
-        if arrival:
-            # Format the arrival time
-            arrival_time = "%02d:%02d" % (arrival // 60, arrival % 60)
-            # Format the route
-            details = [format(start, end, time) for start, end, time in best]
-        else:
-            # We don't have a route from here to there
-            arrival_time = "--:--"
-            details = ["No route found"]
-        # Format for html
-        return "<br/>\n".join(details), arrival_time
+        return describe(self.journey(destination, time, day))
+
+def describe(directions):
+    """
+    Describe a journey
+    :param directions: Time of arrival, path taken (as returned by Station.journey) OR None if no route
+    :return: Textual description, Time of Arrival
+    """
+    arrival = None
+    best = None
+    if directions:
+        arrival, best = directions
+
+    # If we have an arrival time
+    if arrival:
+        # Format the arrival time
+        arrival_time = "%02d:%02d" % (arrival // 60, arrival % 60)
+        # Format the route
+        details = [format(start, end, time) for start, end, time in best]
+    else:
+        # We don't have a route from here to there
+        arrival_time = "--:--"
+        details = ["No route found"]
+    # Format for html
+    return "<br/>\n".join(details), arrival_time
 
 class Route(object):
 
@@ -85,7 +161,12 @@ class Route(object):
         """
         self.route = stops
         self.stops = set(stops)
-        self.schedule = []
+        # Index of stop id -> position on the route (the first time it appears)
+        self.positions = {}
+        for position, stop in enumerate(stops):
+            self.positions.setdefault(stop, position)
+        # The times of the trips, one column for each stop
+        self.schedule = Timetable(len(stops))
 
     def __str__(self):
         """
@@ -96,35 +177,62 @@ class Route(object):
         destination = _stop_ids[self.route[-1]]
         return "%s to %s" % (origin.name, destination.name)
 
-    def add(self, schedule):
+    def position(self, stop):
         """
-        Add a schedule (the order of stops is fixed, so just need the times)
-        :param schedule: A tuple of stop ids, times (in minutes after midnight)
-        :return: None
+        Find where a stop is on this route
+        :param stop: The stop id
+        :return: The index of the stop in the route
+        """
+        return self.positions[stop]
+
+    def time(self, trip, position):
+        """
+        The time a trip is at a stop
+        :param trip: The trip (as returned by next_trip)
+        :param position: The index of the stop in the route
+        :return: The time (minutes after midnight)
+        """
+        return self.schedule.time(trip, position)
+
+    def runs(self, day):
+        """
+        Does any trip on this route run on a day?
+        :param day: The day of the week (0 is Monday, None for any day)
+        :return: True if there are trips that day
         """
-        self.schedule.append([time for stop, time in schedule])
+        return runs(self.schedule.running, day)
 
-    def travel(self, origin, destination, time):
+    def next_trip(self, position, time, day=None):
+        """
+        Find the first trip leaving a stop after the time
+        :param position: The index of the stop in the route
+        :param time: The earliest we can leave (we need to be there before it departs)
+        :param day: The day of the week (0 is Monday, None for trips on any day)
+        :return: The trip OR None if there are no more trips
+        """
+        return self.schedule.next_trip(position, time, day)
+
+    def travel(self, origin, destination, time, day=None):
         """
         Find a route from the origin to the destination leaving after the time
         :param origin: Where are we starting from?
         :param destination: Where are we heading to?
         :param time:
+        :param day: The day of the week (0 is Monday, None for trips on any day)
         :return:
         """
         # Is the destination in this route
-        if destination in self.stops:
+        if destination in self.positions:
             # Find out whether it is before this stop or after it
-            start = self.route.index(origin)
-            end = self.route.index(destination)
+            start = self.position(origin)
+            end = self.position(destination)
             # If the destination is after the start then we have a valid route
             if start < end:
                 # Now find the first one after the time
-                for times in self.schedule:
-                    # We assume that the first time that is greater than start time will get there first
-                    if times[start] > time:
-                        # Return the arrival time and the path taken
-                        return times[end], [(origin, destination, times[start])]
+                trip = self.next_trip(start, time, day)
+                if trip is not None:
+                    # Return the arrival time and the path taken
+                    return self.time(trip, end), [(origin, destination, self.time(trip, start))]
         else:
             return
 
@@ -152,40 +260,19 @@ def _parse(data):
     return station
 
 
-def skip_bom(f):
-    """
-    Skip the byte order mark (Unicode thing) if present
-    :param f: The binary file that we've opened
-    :return: The file is advanced past the byte order mark
+def _new_route(routes, stops):
     """
-    if ord(f.read(1)) == 239:   # File starts with 3 bytes, the first being 239 for unicode
-        f.read(2)
-    else:
-        # We need to go back to the beginning since we read a byte that we didn't need to
-        f.seek(0)
-
-
-def add_route(routes, schedule):
-    """
-    Add a schedule to the routes
+    Create a route and add it to the stations on it
     :param routes: Dictionary (the key is a tuple of the stop ids)
-    :param schedule: A list of tuples with stop id, time (minutes after midnight)
-    :return: None
+    :param stops: Tuple of the stop ids
+    :return: The new route
     """
-    # Get all the stops as a tuple
-    stops = tuple([stop for stop, time in schedule])
-    # Check if the route exists already
-    route = routes.get(stops)
-    if not route:
-        # New route, so add to the dictionary
-        route = Route(stops)
-        routes[stops] = route
-        # Add this route to all the stations contained in the route
-        for stop in stops:
-            _stop_ids[stop].add_route(route)
-        #print route, schedule
-    # Add the times to the route
-    route.add(schedule)
+    route = Route(stops)
+    routes[stops] = route
+    # Add this route to all the stations contained in the route
+    for stop in stops:
+        _stop_ids[stop].add_route(route)
+    return route
 
 def _load():
     """
@@ -241,51 +328,321 @@ def _load():
 
     return stops, stop_ids, closest
 
-# Load the station names and locations on the map
-_stops, _stop_ids, _closest = _load()
+def _restore(compiled):
+    """
+    Get the stops from the compiled snapshot
+    :param compiled: The snapshot (as returned by snapshot.read)
+    :return: The same as _load
+    """
+    stations, names, closest, routes = compiled
+    stop_ids = {}
+    for name, location, id, aka in stations:
+        stop_ids[id] = Station(name, location, id, aka)
+    stops = dict((name, stop_ids[id]) for name, id in names.items())
+    return stops, stop_ids, closest
+
+# Load the station names and locations on the map (from the snapshot if it's up to date). The files
+# are described before they are read, so the snapshot is rebuilt if they change while we're running
+_station_signature = snapshot.signature(_STATION_SOURCES)
+_compiled = snapshot.read(_SNAPSHOT, _SOURCES)
+_stops, _stop_ids, _closest = _restore(_compiled) if _compiled else _load()
 
-def _load_routes():
+def _map_size():
+    """
+    How big is the map? (from the GIF header, so we don't need to open the image)
+    :return: (width, height) in pixels OR None if there isn't a map
+    """
+    try:
+        with open(_MAP, "rb") as f:
+            header = f.read(10)
+    except IOError:
+        return
+    if len(header) == 10 and header[:3] == "GIF":
+        return struct.unpack("<HH", header[6:10])
 
+def _project():
+    """
+    Work out where every station is on the map
+    :return: Dictionary of station id -> x, y
+    """
+    # The stations we know the position of are the control points
+    controls = [(_stops[name].location, _closest[name]) for name in _closest if name in _stops]
+    stations = list(_stop_ids.values())
+    try:
+        # Fit the map to the control points, then convert all the stations at once (keeping them on the map)
+        pixels = projection.locate(projection.fit(controls), controls, [station.location for station in stations],
+                                   _map_size())
+    except ValueError:
+        # Not enough control points to fit, use the position of the closest one
+        mapped = spatial.Grid([(location, pixel) for location, pixel in controls])
+        pixels = [mapped.nearest(*station.location) for station in stations]
+    positions = dict(zip([station.id for station in stations], pixels))
+    # Keep the positions that were placed by hand
+    for station in stations:
+        if station.name in _closest:
+            positions[station.id] = _closest[station.name]
+    return positions
+
+# The x, y position on the map of every station
+_positions = _project()
+
+def _index():
+    """
+    Build the index of every station, for finding the ones near a location
+    :return: spatial.Grid of the stations
+    """
+    stations = list(_stop_ids.values())
+    # Longitudes are closer together away from the equator, scale them so distances are on the ground
+    latitude = sum(station.location[0] for station in stations) / len(stations)
+    return spatial.Grid([(station.location, station) for station in stations], scale=cos(radians(latitude)))
+
+_nearby = _index()
+# The station names and aka names, for autocomplete and forgiving typos
+_names = search.Index(_stops)
+# Stations close together share a forecast, work out which ones now
+snap([station.location for station in _stop_ids.values()])
+
+def nearby(lat, lon, count=5):
+    """
+    Find the stations closest to a location
+    :param lat: The latitude
+    :param lon: The longitude
+    :param count: How many stations
+    :return: List of (station, great circle distance in kilometres), closest first
+    """
+    # The index is flat, so get a few extra and sort them by the distance on the earth
+    stations = [station for squared, station in _nearby.closest(lat, lon, count * 2 + 4)]
+    distances = sorted((spatial.distance((lat, lon), station.location), station.id, station) for station in stations)
+    return [(station, distance) for distance, id, station in distances[:count]]
+
+def _load_routes():
+    """
+    Load all the trips from stop_times.txt into routes
+    :return: Dictionary of routes (the key is a tuple of the stop ids)
+    """
     routes = {}
 
     # Use join so that code works irrespective of platform
     file = os.path.join("google_transit", "stop_times.txt")
+    # The days each trip runs (every day if there's no calendar)
+    services = gtfs.read_services(os.path.join("google_transit", "trips.txt"),
+                                  os.path.join("google_transit", "calendar.txt"))
 
-    # Open the file as a binary
-    with open(file, "rb") as f:
-        # Skip byte order mark (if present)
-        skip_bom(f)
-        # Read each entry as a dictionary
-        csv = DictReader(f)
-        # Each trip has an id, so initialize with none
-        trip = None
-        # The stops and times of each stop
-        schedule = []
-        for data in csv:
-            # Started a new route
-            if trip != data['trip_id']:
-                # Did we already have a route? If so lets add it
-                if schedule:
-                    # Add the route
-                    add_route(routes, schedule)
-                    # And start a new schedule
-                    schedule = []
-                # We are starting a new route
-                trip = data['trip_id']
-
-            # Get the hours minutes and seconds from the arrival time
-            h, m, s = map(int, data['arrival_time'].split(':'))
-            # Add the stop and time to the schedule
-            schedule.append((int(data['stop_id']), h * 60 + m))
-
-        # Add the last route
-        add_route(routes, schedule)
+    # The trips grouped by their stops (big files are read by several processes)
+    for stops, (trips, days) in gtfs.read_routes(file, services).items():
+        # New route, so add to the dictionary
+        route = _new_route(routes, stops)
+        # Add the times to the route
+        route.schedule.extend(trips, days)
 
     return routes
 
-_routes = _load_routes()
+def _restore_routes(compiled):
+    """
+    Get the routes from the compiled snapshot
+    :param compiled: The snapshot (as returned by snapshot.read)
+    :return: The same as _load_routes
+    """
+    routes = {}
+    for stops, columns, days, fifo in compiled[3]:
+        route = _new_route(routes, stops)
+        route.schedule.load(columns, days, fifo)
+    return routes
 
-def station_names():
+def compile_snapshot(route_signature=None):
+    """
+    Write the stations and routes that have been loaded to the snapshot
+    :param route_signature: snapshot.signature of the route files when they were read (None for now)
+    :return: True if the snapshot was written
+    """
+    if route_signature is None:
+        route_signature = snapshot.signature(_ROUTE_SOURCES)
+    stations = [(station.name, station.location, station.id, station.aka) for station in _stop_ids.values()]
+    names = dict((name, station.id) for name, station in _stops.items())
+    routes = [(stops, route.schedule.columns, route.schedule.days, route.schedule.fifo)
+              for stops, route in _routes.items()]
+    # The stations are the ones read when we started, even if the files have changed since
+    signed = _station_signature + route_signature[1:]
+    return snapshot.write(_SNAPSHOT, _SOURCES, stations, names, _closest, routes, signed)
+
+# The routes are loaded on demand (or in the background by start_loading)
+_routes = {}
+# Set once the routes have loaded
+_ready = threading.Event()
+# Set once loading has finished, whether or not the routes loaded
+_finished = threading.Event()
+# Why the routes couldn't be loaded (None if they have, or haven't been tried yet)
+_failure = [None]
+# Stops two threads loading the routes at the same time
+_loading = threading.Lock()
+# The thread loading the routes in the background (if one has been started)
+_loader = []
+# The journeys found, by origin and destination id, for ranges of departure times
+_journeys = RangeCache(_JOURNEY_CACHE)
+
+def load_routes():
+    """
+    Load the routes (if they haven't been already), from the snapshot if it's up to date
+    :return: None (see failure if they couldn't be loaded)
+    """
+    global _compiled
+    with _loading:
+        if _finished.is_set():
+            return
+        try:
+            if _compiled:
+                _routes.update(_restore_routes(_compiled))
+            else:
+                # Parse the timetable, and compile it so next time is quicker
+                route_signature = snapshot.signature(_ROUTE_SOURCES)
+                _routes.update(_load_routes())
+                compile_snapshot(route_signature)
+        except Exception as error:
+            # Don't leave anyone waiting for routes that aren't coming (reload_routes tries again)
+            _routes.clear()
+            _failure[0] = "Unable to load the timetable (%s)" % error
+            _finished.set()
+            return
+        # Don't need to keep the snapshot data around
+        _compiled = None
+        # Forget any journeys from a previous timetable
+        _journeys.clear()
+        _ready.set()
+        _finished.set()
+
+def reload_routes():
+    """
+    Load the routes again (e.g. a new stop_times.txt has been installed, see webserver.py), the stations
+    stay the same (a new stops.txt or closest.txt needs a restart, the snapshot is rebuilt then)
+    :return: None
+    """
+    global _compiled
+    with _loading:
+        # Journey queries wait until the new routes have loaded
+        _ready.clear()
+        _finished.clear()
+        _failure[0] = None
+        for station in _stop_ids.values():
+            station.routes = []
+            station.destinations = {}
+        _routes.clear()
+        del _connections[:]
+        # The workers have a copy of the old routes
+        for pool in _pool:
+            pool.terminate()
+        del _pool[:]
+        _compiled = snapshot.read(_SNAPSHOT, _SOURCES)
+    load_routes()
+
+def cache_stats():
+    """
+    How well is the journey cache doing?
+    :return: Dictionary of hits, misses and entries
+    """
+    return _journeys.stats()
+
+def start_loading():
+    """
+    Load the routes on a background thread (so the web server can start straight away)
+    :return: None
+    """
+    if not _loader:
+        thread = threading.Thread(target=load_routes, name="timetable")
+        # Don't stop the program exiting
+        thread.daemon = True
+        _loader.append(thread)
+        thread.start()
+
+def ready():
+    """
+    Have the routes finished loading?
+    :return: True if journeys can be planned
+    """
+    return _ready.is_set()
+
+def failure():
+    """
+    Why couldn't the routes be loaded?
+    :return: The error message OR None if they have loaded (or are still loading)
+    """
+    return _failure[0]
+
+def wait(timeout=None):
+    """
+    Wait for the routes to load (loading them now if nobody has started loading them)
+    :param timeout: The most seconds to wait (None to wait until they have loaded or failed to)
+    :return: True if the routes have loaded (see failure if they couldn't be)
+    """
+    if not _loader:
+        load_routes()
+    _finished.wait(timeout)
+    return _ready.is_set()
+
+# How many times each station has been asked for (the forecasts for the most popular are kept fresh, see warmer.py)
+_asked = Counter()
+_asked_lock = threading.Lock()
+
+def _ask(station):
+    """
+    Count a station being asked for
+    :param station: The station
+    :return: None
+    """
+    with _asked_lock:
+        _asked[station.name] += 1
+
+def popular(count, ranking=()):
+    """
+    The stations asked for the most
+    :param count: How many stations
+    :param ranking: Station names (or akas), most popular first, for stations asked for equally
+                    (e.g. none of them since the server started)
+    :return: List of stations, most popular first
+    """
+    order = {}
+    for name in ranking:
+        station = find_station(name)
+        if station:
+            order.setdefault(station.name, len(order))
+    with _asked_lock:
+        asked = dict(_asked)
+    # Only the stations that have been asked for, or are in the ranking
+    names = set(asked) | set(order)
+    names = sorted(names, key=lambda name: (-asked.get(name, 0), order.get(name, len(order)), name))
+    return [_stops[name] for name in names[:count]]
+
+def _not_loaded():
+    """
+    What to say instead of the journey when the routes aren't there
+    :return: The message
+    """
+    return failure() or "The timetable is still loading, please try again in a moment"
+
+def find_station(name):
+    """
+    Find a station by name, ignoring case and punctuation (and one typo if there's only one station it could be)
+    :param name: The station name or aka
+    :return: The station OR None if there isn't one with that name
+    """
+    return _stops.get(name) or _names.find(name)
+
+def complete(text, limit=10):
+    """
+    Suggest station names for what has been typed so far
+    :param text: The start of the name (or of any word in it), can have a typo
+    :param limit: The most names to suggest
+    :return: List of station names (or aka names), the best first
+    """
+    return _names.search(text, limit)
+
+def station_names(aka=True):
+    """
+    The names of the stations
+    :param aka: Include the aka names as well
+    :return: Sorted list of names
+    """
+    if not aka:
+        return sorted(set(station.name for station in _stop_ids.values()))
     # Sort the stations into alphabetical order
     return sorted(_stops.keys())
 
@@ -349,6 +706,28 @@ def _parse_time(time):
         return
 
 
+def minutes(time):
+    """
+    Converts time from hh:mm{am|pm} format (or now) into minutes after midnight
+    :param time: time as string
+    :return: minutes after midnight OR None if unable to parse
+    """
+    time = _parse_time(time)
+    if time:
+        return time[0] * 60 + time[1]
+
+
+def weekday(day):
+    """
+    Converts a day (today, tomorrow, monday, 2 days from now ...) into the day of the week
+    :param day: The day as a string
+    :return: The day of the week (0 is Monday) OR None if unable to parse
+    """
+    date = _parse_date(day.split()) if day else None
+    if date:
+        return date.weekday()
+
+
 def _parse_date(date_list):
     """
     Parse a relative date
@@ -393,20 +772,21 @@ def _parse_date(date_list):
     return date
 
 
-def process(args):
+def _parse_args(args):
     """
-    Process the arguments and returns the weather
+    Process the arguments into the station and the date and time
     :param args: The arguments are in the format returned by command line
-    :return: The weather dictionary or None if error
+    :return: station, datetime OR the help dictionary (with the error) if they aren't valid
     """
     # Command line needs 2 arguments at least to be valid, display help if it isn't
     if len(args) < 3:
         return help(args)
     # Get the matching station for the station name
-    station = _stops.get(args[1])
+    station = find_station(args[1])
     # If not a valid station we didn't find the station
     if not station:
         return help(args, "Unable to find a station called %s" % args[1])
+    _ask(station)
     # Get the time as hours and minutes
     time = _parse_time(args[-1])
     # If not a valid time, display help and error message
@@ -420,15 +800,82 @@ def process(args):
     else:
         date = datetime.now()
     # Combine the date and time to get the datetime
-    date = date.replace(hour=time[0], minute=time[1], second=0)
-    # Get the unix timecode
-    unix = int(mktime(date.timetuple()))
+    return station, date.replace(hour=time[0], minute=time[1], second=0, microsecond=0)
+
+def _unix(date):
+    """
+    Get the unix timecode
+    :param date: The datetime (local time)
+    :return: Seconds since 1970
+    """
+    return int(mktime(date.timetuple()))
+
+def process(args):
+    """
+    Process the arguments and returns the weather
+    :param args: The arguments are in the format returned by command line
+    :return: The weather dictionary or None if error
+    """
+    parsed = _parse_args(args)
+    # The help (with the error)
+    if isinstance(parsed, dict):
+        return parsed
+    station, date = parsed
     # Get the weather for location and time
-    weather = forecast(station.location, unix)
+    weather = forecast(station.location, _unix(date))
     if weather:
         # Get the location that matches (to convert to canonical version
         weather['location'] = station.name
         weather['id'] = station.id
+        # So the journey only uses the trips running that day
+        weather['day'] = date.weekday()
+    return weather
+
+def plan(args, destination):
+    """
+    Process the arguments, find the journey to destination and get the weather where it starts
+    and at the destination when it arrives (both forecasts are fetched at the same time)
+    :param args: The arguments are in the format returned by command line
+    :param destination: The name of the station where the journey terminates
+    :return: The weather dictionary (with the route and the weather on arrival) or None if error
+    """
+    parsed = _parse_args(args)
+    # The help (with the error)
+    if isinstance(parsed, dict):
+        return parsed
+    station, date = parsed
+    end = find_station(destination)
+    if not end:
+        return help(args, "Unable to find a station called %s" % destination)
+    _ask(end)
+    # Give the timetable a little while to load
+    loaded = wait(_WARM_UP)
+    directions = station.journey(end, date.hour * 60 + date.minute, date.weekday()) if loaded else None
+    requests = [(station.location, _unix(date))]
+    if directions:
+        # Arrival is in minutes after midnight (can be after 24:00)
+        arrival = date.replace(hour=0, minute=0) + timedelta(minutes=directions[0])
+        requests.append((end.location, _unix(arrival)))
+    results = forecasts(requests)
+    weather = results[0]
+    if not weather:
+        return
+    weather['location'] = station.name
+    weather['id'] = station.id
+    weather['day'] = date.weekday()
+    if loaded:
+        weather['route'], weather['arrive'] = describe(directions)
+    else:
+        weather['route'], weather['arrive'] = _not_loaded(), "--:--"
+    weather['destination'] = end.id
+    weather['destination_station'] = end.name
+    # The weather when we get there (if we know when that is)
+    arriving = results[1] if len(results) > 1 else None
+    weather['arrivalTemperature'] = arriving['temperature'] if arriving else "--"
+    weather['arrivalSummary'] = arriving['summary'] if arriving else "Unknown"
+    weather['arrivalIcon'] = arriving['icon'] if arriving else "na"
+    # The next few hours, from the same forecast (so nothing more to fetch)
+    weather['hourly'] = hourly(station.location, _unix(date))
     return weather
 
 def main(args):
@@ -473,51 +920,25 @@ if __name__ == "__main__":
     #test('"melbourne central" wednesday 5:20pm')
     #test('Hallam 2 days from tomorrow 5:20pm')
     #test('Hallam 2 days from now 5:20pm')
-    main(sys.argv)
+    if sys.argv[1:] == ["compile"]:
+        # Rebuild the snapshot (e.g. after installing a new timetable)
+        load_routes()
+        if failure():
+            print failure()
+            sys.exit(1)
+        compile_snapshot()
+    else:
+        main(sys.argv)
 
 
 def xy(query):
     """
-    Get the closest station on the map
+    Get the position of a station on the map
     :param query: The requested station id
     :return: The x, y posirion on the map
     """
-    # Find the station referred to
-    station = _stop_ids[int(query)]
-    # Do we already have a location for it?
-    if station.name in _closest:
-        return _closest[station.name]
-
-    # Let's find the closest position on the map
-
-    # The closest station
-    closest = None
-    # The closest distance
-    closest_distance = 9e9
-    # Get the laritude and longitude
-    lat, lon = station.location
-
-    for name in _stops:
-        # No point checking if we don't have an xy
-        if name not in _closest:
-            continue
-        # Get the latitude and longitude of the station
-        lat_diff, lon_diff = _stops[name].location
-        lat_diff -= lat
-        lon_diff -= lon
-        # Find the distance (squared)
-        distance = lat_diff * lat_diff + lon_diff * lon_diff
-        # We only care about the closest, so we don't need to square root
-        if distance < closest_distance:
-            # Best so far
-            closest_distance = distance
-            closest = name
-
-    # Cache the result
-    _closest[station.name] = _closest[closest]
-
-    # Return the x, y location on the map
-    return _closest[closest]
+    # Worked out for every station when they were loaded
+    return _positions[int(query)]
 
 
 def route(origin, destination, weather):
@@ -528,10 +949,98 @@ def route(origin, destination, weather):
     :param weather:
     :return:
     """
-    start = _stops[origin]
-    end = _stops[destination]
+    start = find_station(origin)
+    end = find_station(destination)
     h,m = _parse_time(weather['time'])
     time = h * 60 + m
-    weather['route'], weather['arrive'] = start.travel(end, time)
+    # Give the timetable a little while to load, otherwise say so
+    if wait(_WARM_UP):
+        weather['route'], weather['arrive'] = start.travel(end, time, weather.get('day'))
+    else:
+        weather['route'], weather['arrive'] = _not_loaded(), "--:--"
     weather['destination'] = end.id
     weather['destination_station'] = end.name
+
+# The processes used for travel matrices (started when first needed, after the routes have loaded)
+_pool = []
+
+def _arrivals(query):
+    """
+    Find the earliest arrival at each of the stations from one origin
+    :param query: origin id, time leaving, list of destination ids, day of the week
+    :return: List of arrival times (minutes after midnight, None if not reachable)
+    """
+    origin, time, destinations, day = query
+    # One search gives the arrival at every stop
+    best = journey.earliest_arrival(_stop_ids, origin, time, day=day)[0]
+    return [best.get(destination) for destination in destinations]
+
+def travel_matrix(names, time, processes=None, day=None):
+    """
+    Find the earliest arrival between every pair of stations. Each origin is a separate search (one
+    search gives every destination, and the searches for different origins share nothing, so they
+    are spread over several processes instead)
+    :param names: The names of the stations
+    :param time: What time are we leaving? (minutes after midnight)
+    :param processes: How many processes to use (default is one for each cpu)
+    :param day: The day of the week (0 is Monday, None for trips on any day)
+    :return: List of rows (one for each origin) of arrival times at each destination
+             (minutes after midnight, None if not reachable, the time leaving for the origin itself)
+    """
+    if not wait():
+        raise IOError(failure())
+    ids = [_stops[name].id for name in names]
+    queries = [(origin, time, ids, day) for origin in ids]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 2 or len(ids) < _PARALLEL_ORIGINS:
+        return [_arrivals(query) for query in queries]
+    # Two requests at once would each start a pool (and one would never be closed)
+    with _loading:
+        if not _pool:
+            # The workers get a copy of the routes that have been loaded
+            _pool.append(multiprocessing.Pool(processes))
+        pool = _pool[0]
+    # Several origins at a time, so there aren't too many messages between processes
+    return pool.map(_arrivals, queries, max(1, len(queries) // (processes * 4)))
+
+def reachable(origin, time, budget, day=None):
+    """
+    Find everywhere that can be reached from a station within a time (an isochrone)
+    :param origin: The name of the station where the journey commences
+    :param time: What time are we leaving? (minutes after midnight)
+    :param budget: How long we have (minutes)
+    :param day: The day of the week (0 is Monday, None for trips on any day)
+    :return: List of (station, arrival time) in order of arrival (not including the origin)
+    """
+    if not wait():
+        raise IOError(failure())
+    start = find_station(origin)
+    # One search gives the earliest arrival at every stop, ignoring anything arriving too late
+    best = journey.earliest_arrival(_stop_ids, start.id, time, latest=time + budget, day=day)[0]
+    arrivals = [(arrival, _stop_ids[stop].name, _stop_ids[stop]) for stop, arrival in best.items() if stop != start.id]
+    return [(station, arrival) for arrival, name, station in sorted(arrivals)]
+
+# Every hop of every trip, for profiles (built when first needed)
+_connections = []
+
+def profile(origin, destination, start, end, day=None):
+    """
+    Find every useful journey leaving between two times (where leaving earlier doesn't get there sooner)
+    :param origin: The name of the station where the journey commences
+    :param destination: The name of the station where the journey terminates
+    :param start: The earliest we can leave (minutes after midnight)
+    :param end: The latest we want to leave (minutes after midnight)
+    :param day: The day of the week (0 is Monday, None for trips on any day)
+    :return: List of (departure, arrival) in minutes after midnight
+    """
+    if not wait():
+        raise IOError(failure())
+    with _loading:
+        if not _connections:
+            _connections.append(journey.connections(_routes.values()))
+    first = find_station(origin)
+    last = find_station(destination)
+    # Nothing arriving after the best journey leaving after the end is worth it
+    after = journey.travel(_stop_ids, first.id, last.id, end, day=day)
+    return journey.profile(_connections[0], first.id, last.id, start, end, after[0] if after else None, day)
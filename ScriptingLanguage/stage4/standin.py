@@ -0,0 +1,162 @@
+#!/usr/bin/python
+"""
+A stand-in for the forecast.io server, for development and load testing
+
+It answers /forecast/<key>/<lat>,<lon>,<time> with made up (but repeatable:
+the same location and day always gets the same weather) json in the same
+format as forecast.io, after a delay, and fails some of the requests so we can
+see how the rest of the program copes with a slow or unreliable server.
+
+    python standin.py [port] [latency in ms] [jitter in ms] [error rate]
+
+then run the web server with FORECAST_BACKEND=http://127.0.0.1:<port>
+"""
+import sys
+import json
+import time
+import zlib
+import random
+import threading
+from math import cos, pi
+from datetime import datetime
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+PORT_NUMBER = 34568
+# Seconds between the hourly forecasts
+_HOUR = 3600
+# (summary, icon) for the weather, from the most to the least cloud
+_WEATHER = [("Rain", "rain"), ("Drizzle", "rain"), ("Overcast", "cloudy"), ("Mostly Cloudy", "partly-cloudy-day"),
+            ("Partly Cloudy", "partly-cloudy-day"), ("Clear", "clear-day")]
+
+
+def _weather(lat, lon, unix):
+    """
+    Make up the forecast for a day
+    :param lat: The latitude
+    :param lon: The longitude
+    :param unix: The unix timestamp asked for
+    :return: Dictionary of the forecast.io json
+    """
+    day = datetime.fromtimestamp(unix).date()
+    midnight = int(time.mktime(day.timetuple()))
+    # The same location and day always gets the same weather
+    chance = random.Random(zlib.crc32("%.3f,%.3f,%d" % (lat, lon, day.toordinal())))
+    low = round(chance.uniform(4, 16), 1)
+    high = round(low + chance.uniform(4, 14), 1)
+    cloud = chance.randrange(len(_WEATHER))
+    wind = chance.uniform(0, 12)
+    bearing = chance.randrange(360)
+    hours = []
+    for hour in range(24):
+        # Coldest at 4am and warmest at 4pm
+        warmth = (1 - cos((hour - 4) * pi / 12)) / 2
+        temperature = round(low + (high - low) * warmth, 1)
+        speed = round(max(0.0, wind + chance.uniform(-2, 2)), 1)
+        summary, icon = _WEATHER[min(len(_WEATHER) - 1, max(0, cloud + chance.randrange(-1, 2)))]
+        hours.append({"time": midnight + hour * _HOUR,
+                      "temperature": temperature,
+                      "apparentTemperature": round(temperature - speed / 4, 1),
+                      "summary": summary,
+                      "icon": icon,
+                      "windSpeed": speed,
+                      "windBearing": (bearing + chance.randrange(-20, 21)) % 360,
+                      })
+    currently = dict(hours[min(23, max(0, (unix - midnight) // _HOUR))], time=unix)
+    return {"latitude": lat,
+            "longitude": lon,
+            "currently": currently,
+            "hourly": {"data": hours},
+            "daily": {"data": [{"time": midnight,
+                                "temperatureMin": low,
+                                "temperatureMax": high,
+                                "summary": _WEATHER[cloud][0] + " throughout the day.",
+                                "sunriseTime": midnight + 6 * _HOUR + chance.randrange(_HOUR),
+                                "sunsetTime": midnight + 19 * _HOUR + chance.randrange(_HOUR),
+                                }]},
+            }
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    # Handle each request on its own thread (so the delays overlap, like a real server)
+    daemon_threads = True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests (like forecast.io)
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, code, body):
+        """
+        Send a response
+        :param code: The HTTP status
+        :param body: The body of the response
+        :return: None
+        """
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        # Take as long as a real server
+        time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+        with server.lock:
+            server.requests += 1
+            failed = random.random() < server.error_rate
+            if failed:
+                server.errors += 1
+        if failed:
+            self._reply(503, json.dumps({"code": 503, "error": "The stand-in failed on purpose"}))
+            return
+        try:
+            # /forecast/<key>/<lat>,<lon>,<time>?units=si
+            lat, lon, unix = self.path.split("?")[0].split("/")[3].split(",")
+            body = json.dumps(_weather(float(lat), float(lon), int(unix)))
+        except (IndexError, ValueError):
+            self._reply(400, json.dumps({"code": 400, "error": "Poorly formatted request"}))
+            return
+        self._reply(200, body)
+
+    def log_message(self, format, *args):
+        # Too many requests to print each one
+        pass
+
+
+def serve(port=PORT_NUMBER, latency=0.0, jitter=0.0, error_rate=0.0):
+    """
+    Make a stand-in server (call serve_forever, or start a thread that does)
+    :param port: The port to listen on (0 for any free port, see server_address)
+    :param latency: How many seconds to take answering each request
+    :param jitter: The latency varies by up to this many seconds either way
+    :param error_rate: The fraction of requests that fail (with 503 Service Unavailable)
+    :return: The server
+    """
+    server = ThreadedHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    # How many requests, and how many of them failed
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.errors = 0
+    return server
+
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:] + [None] * 4
+    port = int(arguments[0] or PORT_NUMBER)
+    latency = float(arguments[1] or 0) / 1000
+    jitter = float(arguments[2] or 0) / 1000
+    error_rate = float(arguments[3] or 0)
+    server = serve(port, latency, jitter, error_rate)
+    print 'Stand-in forecast server on port %d (%dms latency, %d%% errors)' % (port, latency * 1000,
+                                                                              error_rate * 100)
+    print 'Run the web server with FORECAST_BACKEND=http://127.0.0.1:%d' % port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print '^C received, %d requests, %d failed' % (server.requests, server.errors)
+        server.socket.close()
@@ -0,0 +1,105 @@
+"""
+Checks profile against travel run for every minute of the range (on a made up network)
+
+    python -m unittest test_journey
+"""
+import random
+import unittest
+import journey
+from timetable import Timetable, runs, EVERY_DAY
+
+
+class _Route(object):
+    # Just what journey needs from stage2.Route (importing stage2 loads the timetable)
+
+    def __init__(self, stops):
+        self.route = stops
+        self.positions = {}
+        for position, stop in enumerate(stops):
+            self.positions.setdefault(stop, position)
+        self.schedule = Timetable(len(stops))
+
+    def position(self, stop):
+        return self.positions[stop]
+
+    def time(self, trip, position):
+        return self.schedule.time(trip, position)
+
+    def runs(self, day):
+        return runs(self.schedule.running, day)
+
+    def next_trip(self, position, time, day=None):
+        return self.schedule.next_trip(position, time, day)
+
+
+class _Station(object):
+
+    def __init__(self):
+        self.routes = []
+
+
+def _network(seed, stops=30, lines=12):
+    """
+    Make up a network
+    :param seed: For the random numbers (the same seed gives the same network)
+    :param stops: How many stops
+    :param lines: How many routes
+    :return: (stations, routes)
+    """
+    chance = random.Random(seed)
+    stations = dict((stop, _Station()) for stop in range(stops))
+    routes = []
+    for line in range(lines):
+        route = _Route(tuple(chance.sample(range(stops), chance.randint(3, 8))))
+        hops = [chance.randint(2, 9) for stop in route.route[1:]]
+        for trip in range(chance.randint(5, 30)):
+            time = chance.randint(300, 1300)
+            times = [time]
+            for hop in hops:
+                # No trip overtakes another (travel boards the next trip to leave, which
+                # isn't always the first to arrive when they do)
+                times.append(times[-1] + hop)
+            route.schedule.add(times, chance.choice([EVERY_DAY, EVERY_DAY, 0x1f, 0x60]))
+        routes.append(route)
+        for stop in set(route.route):
+            stations[stop].routes.append(route)
+    return stations, routes
+
+
+class ProfileTest(unittest.TestCase):
+
+    def test_matches_travel_every_minute(self):
+        for seed in range(20):
+            stations, routes = _network(seed)
+            connections = journey.connections(routes)
+            chance = random.Random(seed)
+            for pair in range(10):
+                origin, destination = chance.sample(sorted(stations), 2)
+                day = chance.choice([None, 0, 5])
+                start = chance.randint(300, 900)
+                end = start + chance.randint(30, 400)
+                after = journey.travel(stations, origin, destination, end, day=day)
+                found = journey.profile(connections, origin, destination, start, end,
+                                        after[0] if after else None, day)
+                # Leaving later never gets there as soon (or it wouldn't be useful)
+                for (departure, arrival), (later, later_arrival) in zip(found, found[1:]):
+                    self.assertLess(departure, later)
+                    self.assertLess(arrival, later_arrival)
+                for departure, arrival in found:
+                    self.assertTrue(start <= departure <= end)
+                    # Nothing leaving after it gets there as soon
+                    best = journey.travel(stations, origin, destination, departure, day=day)
+                    self.assertTrue(best is None or best[0] > arrival, (seed, origin, destination, departure))
+                # And every minute, the best journey is one of them (or leaves after the end)
+                for minute in range(start, end + 1):
+                    best = journey.travel(stations, origin, destination, minute - 1, day=day)
+                    choices = [arrival for departure, arrival in found if departure >= minute]
+                    if choices:
+                        self.assertEqual(best[0], min(choices), (seed, origin, destination, minute))
+                    else:
+                        # Nothing in the range gets there sooner than leaving after the end
+                        self.assertEqual(best and best[0], after and after[0], (seed, origin, destination, minute))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+Checks every station is drawn on the map
+
+    python -m unittest test_projection   (from this directory, stage2 reads the stations from here)
+"""
+import unittest
+import projection
+
+# Control points on a made up map: 100 pixels for each 0.1 degrees, north up
+_CONTROLS = [((-37.8, 145.0), (100, 100)), ((-37.8, 145.2), (300, 100)),
+             ((-37.9, 145.0), (100, 200)), ((-37.9, 145.2), (300, 200))]
+
+
+class LocateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.coefficients = projection.fit(_CONTROLS)
+
+    def test_inside_the_control_points(self):
+        self.assertEqual(projection.locate(self.coefficients, _CONTROLS, [(-37.85, 145.1)], (400, 300)), [(200, 150)])
+
+    def test_past_the_control_points(self):
+        # The fit would put it off the bottom of the map, the closest control point is on it
+        self.assertEqual(projection.project(self.coefficients, [(-38.2, 145.19)]), [(290, 500)])
+        self.assertEqual(projection.locate(self.coefficients, _CONTROLS, [(-38.2, 145.19)], (400, 300)), [(300, 200)])
+
+    def test_kept_on_the_map(self):
+        controls = _CONTROLS + [((-38.1, 145.1), (200, 400))]
+        located = projection.locate(projection.fit(controls), controls, [(-38.1, 145.1)], (400, 300))
+        self.assertEqual(located, [(200, 299)])
+
+
+class StationTest(unittest.TestCase):
+
+    def test_every_station_is_on_the_map(self):
+        import stage2
+        width, height = stage2._map_size()
+        for id, station in stage2._stop_ids.items():
+            x, y = stage2.xy(id)
+            self.assertTrue(0 <= x < width and 0 <= y < height, (station.name, x, y))
+
+
+if __name__ == "__main__":
+    unittest.main()
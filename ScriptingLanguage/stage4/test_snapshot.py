@@ -0,0 +1,57 @@
+"""
+Checks the snapshot is only used while the files it was built from are unchanged
+
+    python -m unittest test_snapshot
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+import snapshot
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "timetable.snapshot")
+        self.sources = [os.path.join(self.directory, name) for name in ("stops.txt", "stop_times.txt")]
+        for source in self.sources:
+            with open(source, "w") as f:
+                f.write("before\n")
+        self.stations = [("Altona", (-37.87, 144.83), 1, "Altona")]
+        self.routes = [((1, 2), [array("H", [600, 660]), array("H", [610, 670])], array("B", [0x7f, 0x1f]), True)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, signed=None):
+        return snapshot.write(self.path, self.sources, self.stations, {"Altona": 1}, {"Altona": (245, 241)},
+                              self.routes, signed)
+
+    def test_read_back(self):
+        self.assertTrue(self._write())
+        stations, names, closest, routes = snapshot.read(self.path, self.sources)
+        self.assertEqual(closest, {"Altona": (245, 241)})
+        self.assertEqual(routes[0][1][1].tolist(), [610, 670])
+        self.assertEqual(routes[0][2].tolist(), [0x7f, 0x1f])
+        self.assertEqual(os.listdir(self.directory).count("timetable.snapshot"), 1)
+
+    def test_changed_source(self):
+        self.assertTrue(self._write())
+        with open(self.sources[0], "a") as f:
+            f.write("after\n")
+        self.assertEqual(snapshot.read(self.path, self.sources), None)
+
+    def test_changed_since_read(self):
+        # Written after the file changed, from what was read before it changed (e.g. reloading just the routes)
+        signed = snapshot.signature(self.sources)
+        with open(self.sources[0], "a") as f:
+            f.write("after\n")
+        self.assertTrue(self._write(signed))
+        self.assertEqual(snapshot.read(self.path, self.sources), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
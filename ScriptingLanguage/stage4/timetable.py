@@ -0,0 +1,186 @@
+"""
+Column oriented store for the trips along a route
+
+Rather than a list of times for each trip, the times are kept as one typed
+array per stop on the route (minutes after midnight). Trips are kept in order
+of departure so the next departure from any stop is found with a binary search.
+
+Each trip also has a byte with the days of the week it runs (bit 0 is Monday,
+the same as datetime.weekday()), so trips that don't run on the day we want are
+skipped with a bit test, and routes with no trips that day aren't looked at.
+"""
+from array import array
+from bisect import bisect_right
+
+# Unsigned 16 bit minutes (times after midnight can go past 24:00 in GTFS)
+_TYPECODE = 'H'
+# Every day of the week
+EVERY_DAY = 0x7f
+
+
+def runs(days, day):
+    """
+    Does something run on a day?
+    :param days: The days it runs (bit 0 is Monday)
+    :param day: The day of the week (0 is Monday, None for any day)
+    :return: True if it runs that day
+    """
+    return day is None or days >> day & 1
+
+
+class Timetable(object):
+
+    def __init__(self, stops):
+        """
+        Create an empty timetable
+        :param stops: The number of stops on the route
+        :return: None
+        """
+        self.columns = [array(_TYPECODE) for stop in range(stops)]
+        # The days each trip runs
+        self.days = array('B')
+        # The days any trip runs
+        self.running = 0
+        # True while no trip overtakes another (so every column is sorted)
+        self.fifo = True
+
+    def __len__(self):
+        """
+        The number of trips
+        :return: The number of trips in the timetable
+        """
+        return len(self.columns[0])
+
+    def _check(self, trip):
+        """
+        Check a trip doesn't overtake its neighbours (or the columns are no longer sorted)
+        :param trip: The index of the trip that was added
+        :return: None
+        """
+        last = len(self) - 1
+        for column in self.columns:
+            if (trip > 0 and column[trip - 1] > column[trip]) or (trip < last and column[trip] > column[trip + 1]):
+                self.fifo = False
+                return
+
+    def add(self, times, days=EVERY_DAY):
+        """
+        Add a trip, keeping the trips in order of departure
+        :param times: The time at each stop (minutes after midnight)
+        :param days: The days the trip runs (bit 0 is Monday)
+        :return: None
+        """
+        # Where the trip goes so that the first column stays sorted
+        trip = bisect_right(self.columns[0], times[0])
+        if trip == len(self):
+            # Usual case, the trips are in order
+            for column, time in zip(self.columns, times):
+                column.append(time)
+            self.days.append(days)
+        else:
+            for column, time in zip(self.columns, times):
+                column.insert(trip, time)
+            self.days.insert(trip, days)
+        self.running |= days
+        if self.fifo:
+            self._check(trip)
+
+    def extend(self, trips, days=None):
+        """
+        Add a lot of trips at once (sorting once rather than for each trip)
+        :param trips: A list of trips, each a sequence of times
+        :param days: The days each trip runs (None if they all run every day)
+        :return: None
+        """
+        if days is None:
+            days = [EVERY_DAY] * len(trips)
+        # Existing trips as rows, plus the new ones, in order of departure (the days go last)
+        rows = list(zip(*(self.columns + [self.days]))) + [tuple(times) + (day,) for times, day in zip(trips, days)]
+        if not rows:
+            return
+        rows.sort()
+        columns = list(zip(*rows))
+        self.columns = [array(_TYPECODE, column) for column in columns[:-1]]
+        self.days = array('B', columns[-1])
+        self.running = 0
+        for day in set(self.days):
+            self.running |= day
+        # Each column is sorted if no trip overtakes another
+        self.fifo = all(all(a <= b for a, b in zip(column, column[1:])) for column in self.columns)
+
+    def load(self, columns, days, fifo):
+        """
+        Use columns that have already been built (e.g. from the snapshot)
+        :param columns: One array of times for each stop, in order of departure
+        :param days: Array of the days each trip runs
+        :param fifo: Whether every column is sorted
+        :return: None
+        """
+        self.columns = columns
+        self.days = days
+        self.running = 0
+        for day in set(days):
+            self.running |= day
+        self.fifo = fifo
+
+    def time(self, trip, position):
+        """
+        The time a trip is at a stop
+        :param trip: The index of the trip
+        :param position: The index of the stop in the route
+        :return: The time (minutes after midnight)
+        """
+        return self.columns[position][trip]
+
+    def next_trip(self, position, time, day=None):
+        """
+        Find the first trip leaving a stop after the time
+        :param position: The index of the stop in the route
+        :param time: The earliest we can leave (we need to be there before it departs)
+        :param day: The day of the week (0 is Monday, None for trips on any day)
+        :return: The index of the trip OR None if there are no more trips
+        """
+        if not runs(self.running, day):
+            return
+        column = self.columns[position]
+        # Only the trips with this day's bit set
+        mask = EVERY_DAY if day is None else 1 << day
+        days = self.days
+        if self.fifo:
+            # Binary search for the first departure after the time
+            trip = bisect_right(column, time)
+            while trip < len(column) and not days[trip] & mask:
+                trip += 1
+            if trip < len(column):
+                return trip
+            return
+        # A trip overtakes another, so the column isn't sorted, look at all of them
+        best = None
+        for trip, departure in enumerate(column):
+            if departure > time and days[trip] & mask and (best is None or departure < column[best]):
+                best = trip
+        return best
+
+    def next_trips(self, position, times, day=None):
+        """
+        Find the first trip leaving a stop after each of a number of times
+        :param position: The index of the stop in the route
+        :param times: The times we want to leave after
+        :param day: The day of the week (0 is Monday, None for trips on any day)
+        :return: List with the index of the trip for each time (None if there are no more trips)
+        """
+        if not self.fifo or not runs(self.running, day):
+            return [self.next_trip(position, time, day) for time in times]
+        column = self.columns[position]
+        mask = EVERY_DAY if day is None else 1 << day
+        days = self.days
+        trips = [None] * len(times)
+        # Walk the queries in time order along with the column (a merge of the two)
+        trip = 0
+        for query in sorted(range(len(times)), key=times.__getitem__):
+            while trip < len(column) and (column[trip] <= times[query] or not days[trip] & mask):
+                trip += 1
+            if trip == len(column):
+                break
+            trips[query] = trip
+        return trips
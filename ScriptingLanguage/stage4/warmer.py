@@ -0,0 +1,184 @@
+"""
+Keeps the forecasts for the most popular stations fresh
+
+Most of the morning peak asks about a handful of stations, and the first person
+to ask about each one waits for the forecast server. The warmer wakes up every
+minute and fetches the forecasts for the most popular stations again before
+they expire (or if they haven't been fetched yet), so they are already cached.
+
+The popular stations are the ones asked for most since the server started,
+then the order in a popularity list (station names, one per line, most popular
+first) so there is something to warm straight after a restart.
+
+The warmer fetches no more than a number of forecasts a minute, so it doesn't
+use up the API calls that the cache misses need. Stations in the same grid
+square share a forecast (see forecast.snap) so they only need one fetch.
+"""
+import time
+import threading
+from collections import deque
+import stage2
+import forecast
+
+# How many stations to keep warm
+_COUNT = 20
+# The most forecasts the warmer fetches each minute
+_BUDGET = 10
+# Seconds between looking for forecasts to refresh
+_PERIOD = 60
+# Refresh forecasts that expire within this many seconds (longer than the period, so none expire in between)
+_LEAD = 3 * 60
+# The warmer started by start (so the web server can show how it's doing)
+_running = []
+
+
+class Warmer(object):
+
+    def __init__(self, locations, budget=_BUDGET, period=_PERIOD, lead=_LEAD, clock=time.time):
+        """
+        Create a warmer (call start to run it in the background)
+        :param locations: Function giving the locations to keep warm, the most important first
+        :param budget: The most forecasts to fetch each minute
+        :param period: Seconds between looking for forecasts to refresh
+        :param lead: Refresh forecasts that expire within this many seconds
+        :param clock: Function giving the current time in seconds
+        :return: None
+        """
+        self.locations = locations
+        self.budget = budget
+        self.period = period
+        self.lead = lead
+        self._clock = clock
+        # When each fetch in the last minute was made (oldest first)
+        self._fetched = deque()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.warmed = 0
+        self.failed = 0
+        # Forecasts that needed refreshing but were over the budget
+        self.deferred = 0
+
+    def _spend(self, now):
+        """
+        Use one fetch from the budget
+        :param now: The current time
+        :return: True if there was one left this minute
+        """
+        while self._fetched and self._fetched[0] <= now - 60:
+            self._fetched.popleft()
+        if len(self._fetched) >= self.budget:
+            return False
+        self._fetched.append(now)
+        return True
+
+    def run_once(self):
+        """
+        Refresh the forecasts that are about to expire (the most important first, until the budget runs out)
+        :return: The number of forecasts fetched
+        """
+        self.runs += 1
+        now = self._clock()
+        fetched = 0
+        # Each grid square and day only once (a forecast has every hour of the day)
+        done = set()
+        for location in self.locations():
+            # Today, and tomorrow if it will be tomorrow before the next refresh
+            for when in (int(now), int(now + self.lead)):
+                key = forecast.shared(location, when)
+                if key in done:
+                    continue
+                done.add(key)
+                expires = forecast.expires(location, when)
+                if expires is not None and expires - now > self.lead:
+                    # Still fresh
+                    continue
+                if not self._spend(self._clock()):
+                    self.deferred += 1
+                    continue
+                if forecast.refresh(location, when):
+                    self.warmed += 1
+                    fetched += 1
+                else:
+                    self.failed += 1
+        return fetched
+
+    def _run(self):
+        """
+        Refresh the forecasts every period until stopped
+        :return: None
+        """
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                # Try again next time, the forecasts are still fetched when they're asked for
+                self.failed += 1
+            self._stop.wait(self.period)
+
+    def start(self):
+        """
+        Run on a background thread
+        :return: None
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="warmer")
+            # Don't stop the program exiting
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread (after the refresh under way)
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """
+        How is the warmer doing?
+        :return: Dictionary of runs, warmed, failed and deferred (over the budget)
+        """
+        return {"runs": self.runs, "warmed": self.warmed, "failed": self.failed, "deferred": self.deferred}
+
+
+def read_ranking(path):
+    """
+    Read a popularity list
+    :param path: The file name (station names, one per line, most popular first, # for comments)
+    :return: List of station names (empty if there isn't a file)
+    """
+    try:
+        with open(path) as f:
+            lines = [line.split("#")[0].strip() for line in f]
+    except IOError:
+        return []
+    return [line for line in lines if line]
+
+
+def start(path=None, count=_COUNT, budget=_BUDGET):
+    """
+    Keep the forecasts for the most popular stations fresh, in the background
+    :param path: The popularity list (see read_ranking), None to only use what has been asked for
+    :param count: How many stations
+    :param budget: The most forecasts to fetch each minute
+    :return: The warmer
+    """
+    if not _running:
+        ranking = read_ranking(path) if path else []
+        warmer = Warmer(lambda: [station.location for station in stage2.popular(count, ranking)], budget)
+        _running.append(warmer)
+        warmer.start()
+    return _running[0]
+
+
+def stats():
+    """
+    How is the warmer doing?
+    :return: Dictionary of runs, warmed, failed and deferred OR None if it hasn't been started
+    """
+    if _running:
+        return _running[0].stats()
@@ -10,14 +10,22 @@
 # based on a list of routes (declared in the routes file)
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qsl
 from os import curdir, sep
 
 import sys
+import json
+import signal
+import threading
 import importlib
 import webbrowser
 from PIL import Image, ImageDraw
 from StringIO import StringIO
 import stage2
+import forecast
+import warmer
+import responders
 
 import cgi
 
@@ -52,6 +60,15 @@ def getController(method, path):
 
 
 PORT_NUMBER = 34567
+# The forecasts are kept in this database (shared by every server on this host)
+FORECAST_CACHE = 'forecast.sqlite'
+# The stations whose forecasts are kept fresh after a restart (until we've seen which are asked for)
+POPULAR_STATIONS = 'popular.txt'
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    # Handle each request on its own thread (so a slow request doesn't hold up the rest)
+    daemon_threads = True
 
 
 # This class will handles any incoming request from
@@ -134,6 +151,11 @@ class myHandler(BaseHTTPRequestHandler):
                 mimetype = 'text/html'
                 sendReply = True
 
+            # Check for json (these are passed the query parameters)
+            elif self.path.endswith(".json"):
+                mimetype = 'application/json'
+                sendReply = True
+
             # It was a recognized type, send a reply
 
             if sendReply == True:
@@ -160,13 +182,20 @@ class myHandler(BaseHTTPRequestHandler):
 
                 else:
                     try:
-                        self.sendHeader(200, mimetype)
                         method = getController('GET', self.path)
-                        self.wfile.write(method())
+                        if mimetype == 'application/json':
+                            code, page = 200, method(dict(parse_qsl(query or '')))
+                        else:
+                            code, page = 200, method()
+                    except responders.BadRequest as e:
+                        # Tell them what was wrong with the query (as json, like the other errors)
+                        code, page = 400, json.dumps({"error": str(e)})
                     except:
-                        # doesn't seem to work for some reason...
+                        # Nothing has been sent yet, so we can still send an error
                         self.send_error(404, 'Couldn\'t generate page for : %s' % self.path)
                         return
+                    self.sendHeader(code, mimetype)
+                    self.wfile.write(page)
 
             return
 
@@ -222,9 +251,23 @@ class myHandler(BaseHTTPRequestHandler):
 try:
     # Create a web server and define the handler to manage the
     # incoming request
-    server = HTTPServer(('', PORT_NUMBER), myHandler)
+    server = ThreadedHTTPServer(('', PORT_NUMBER), myHandler)
     print 'Started httpserver on port ', PORT_NUMBER
 
+    # Load the timetable in the background, journeys will wait for it (see /ready.json)
+    stage2.start_loading()
+
+    # kill -HUP loads the routes again (e.g. after installing a new stop_times.txt), not on windows
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda number, frame: threading.Thread(target=stage2.reload_routes).start())
+
+    # Keep the forecasts between restarts
+    if not forecast.use_disk_cache(FORECAST_CACHE):
+        print 'Unable to open %s, forecasts are only cached in memory' % FORECAST_CACHE
+
+    # Fetch the forecasts for the popular stations before they're asked for
+    warmer.start(POPULAR_STATIONS)
+
     # Open the web browser with a new tab (so can just run the program and it will open browser for you)
     webbrowser.open("http://localhost:%s" % PORT_NUMBER, new=0)
 